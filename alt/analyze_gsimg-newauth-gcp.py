@@ -21,8 +21,18 @@ to Google Cloud Vision for processing, add results row to Google Sheet.
 
 from __future__ import print_function
 import argparse
+import asyncio
+import contextlib
+import datetime
 import os
+import threading
+import time
 import webbrowser
+from concurrent import futures
+try:
+    import fcntl    # POSIX-only: share token storage across processes
+except ImportError:
+    fcntl = None
 
 from googleapiclient import discovery
 from google_auth_oauthlib.flow import InstalledAppFlow
@@ -37,33 +47,129 @@ PARENT = ''     # YOUR IMG FILE PREFIX
 SHEET = 'YOUR_SHEET_ID'
 TOP = 5       # TOP # of VISION LABELS TO SAVE
 DEBUG = False
+INFLIGHT = 200  # MAX IMAGES IN FLIGHT AT ONCE (async mode)
+THREADS = 32    # THREADS FOR BLOCKING DRIVE, GCS & SHEETS CALLS (async mode)
 
 # process credentials for OAuth2 tokens
 creds = None
 TOKENS = 'tokens.json' # OAuth2 token storage
+REFRESH_AHEAD = 300    # SECS BEFORE EXPIRY TO REFRESH TOKENS
+REFRESH_RETRY = 30     # SECS BETWEEN FAILED REFRESH ATTEMPTS
 SCOPES = (
     'https://www.googleapis.com/auth/drive.readonly',
     'https://www.googleapis.com/auth/devstorage.full_control',
     'https://www.googleapis.com/auth/cloud-vision',
     'https://www.googleapis.com/auth/spreadsheets',
 )
-if os.path.exists(TOKENS):
-    creds = credentials.Credentials.from_authorized_user_file(TOKENS)
-if not (creds and creds.valid):
-    if creds and creds.expired and creds.refresh_token:
-        creds.refresh(Request())
-    else:
-        flow = InstalledAppFlow.from_client_secrets_file(
-                'client_secret.json', SCOPES)
-        creds = flow.run_local_server()
-    with open(TOKENS, 'w') as token:
+
+
+@contextlib.contextmanager
+def tokens_lock():
+    'hold exclusive lock on OAuth2 token storage across worker processes'
+    with open(TOKENS + '.lock', 'a') as lock:
+        if fcntl:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def save_tokens(creds):
+    'atomically (re)write OAuth2 token storage (call with tokens_lock() held)'
+    tmp = '%s.%d' % (TOKENS, os.getpid())
+    with open(tmp, 'w') as token:
         token.write(creds.to_json())
+    # os.replace() is Python 3 only; on POSIX, os.rename() also replaces
+    getattr(os, 'replace', os.rename)(tmp, TOKENS)
+
+
+class TokenManager(object):
+    'refresh OAuth2 tokens ahead of expiry, once for all threads & processes'
+
+    def __init__(self, creds):
+        self.creds = creds
+        self._lock = threading.Lock()
+        # route inline refreshes (expired token, HTTP 401) through here too
+        self._refresh = creds.refresh
+        creds.refresh = self.refresh
+
+    def refresh(self, request=None):
+        'single-flight refresh: adopt tokens refreshed elsewhere or refresh & save'
+        seen = self.creds.token
+        with self._lock:
+            if self.creds.token != seen:    # another thread just refreshed
+                return
+            with tokens_lock():
+                # another process may have refreshed & saved newer tokens
+                if os.path.exists(TOKENS):
+                    saved = credentials.Credentials.from_authorized_user_file(TOKENS)
+                    if saved.token != seen and (self.secs_left(saved) or 0) > REFRESH_AHEAD:
+                        self.creds.token = saved.token
+                        self.creds.expiry = saved.expiry
+                        return
+                self._refresh(request or Request())
+                save_tokens(self.creds)
+
+    @staticmethod
+    def secs_left(creds):
+        'return seconds until access token expires (None if no expiry)'
+        if creds.expiry:
+            return (creds.expiry - datetime.datetime.utcnow()).total_seconds()
+
+    def start(self):
+        'start background thread refreshing tokens before they expire'
+        thread = threading.Thread(target=self._run, name='TokenManager')
+        thread.daemon = True
+        thread.start()
+
+    def _run(self):
+        while self.creds.refresh_token:
+            wait = self.secs_left(self.creds)
+            wait = REFRESH_AHEAD if wait is None else wait - REFRESH_AHEAD
+            if wait > 0:
+                time.sleep(wait)
+                continue
+            try:
+                self.refresh()
+            except Exception as e:  # retry; inline refresh still a fallback
+                print('WARNING: OAuth2 token refresh failed: %s' % e)
+                time.sleep(REFRESH_RETRY)
+
+
+with tokens_lock():
+    if os.path.exists(TOKENS):
+        creds = credentials.Credentials.from_authorized_user_file(TOKENS)
+    if not (creds and creds.valid):
+        if creds and creds.expired and creds.refresh_token:
+            creds.refresh(Request())
+        else:
+            flow = InstalledAppFlow.from_client_secrets_file(
+                    'client_secret.json', SCOPES)
+            creds = flow.run_local_server()
+        save_tokens(creds)
+TokenManager(creds).start()
+
+# create API service endpoints (one per thread if not thread-safe)
+class ThreadLocal(object):
+    'per-thread API client, built on first use in each thread'
+
+    def __init__(self, build):
+        self._build = build
+        self._local = threading.local()
+
+    def __getattr__(self, name):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self._build()
+        return getattr(client, name)
+
 
-# create API service endpoints
-DRIVE  = discovery.build('drive',   'v3', credentials=creds)
-GCS    = storage.Client()
+DRIVE  = ThreadLocal(lambda: discovery.build('drive',  'v3', credentials=creds))
+GCS    = ThreadLocal(storage.Client)
 VISION = vision.ImageAnnotatorClient()
-SHEETS = discovery.build('sheets',  'v4', credentials=creds)
+SHEETS = ThreadLocal(lambda: discovery.build('sheets', 'v4', credentials=creds))
 
 
 def drive_get_img(fname):
@@ -97,7 +203,7 @@ def vision_label_img(img, top):
     'send image to Vision API for label annotation'
 
     # call Vision API to process
-    image = vision.types.Image(content=img)
+    image = vision.Image(content=img)
     labels = VISION.label_detection(image=image, max_results=top).label_annotations
 
     # return top labels for image as CSV for Sheet (row)
@@ -105,6 +211,22 @@ def vision_label_img(img, top):
             label.score*100., label.description) for label in labels)
 
 
+async def vision_label_img_async(client, img, top):
+    'send image to Vision API (async client) for label annotation'
+
+    # call Vision API to process
+    rsp = await client.batch_annotate_images(requests=[{
+            'image':    {'content': img},
+            'features': [{'type_': vision.Feature.Type.LABEL_DETECTION,
+                    'max_results': top}],
+    }])
+    labels = rsp.responses[0].label_annotations
+
+    # return top labels for image as CSV for Sheet (row)
+    return ', '.join('(%.2f%%) %s' % (
+            label.score*100., label.description) for label in labels)
+
+
 def sheet_append_row(sheet, row):
     'append row to a Google Sheet, return #cells added'
 
@@ -157,8 +279,65 @@ def main(fname, bucket, sheet_id, folder, top, debug):
     return True
 
 
+async def main_async(fnames, bucket, sheet_id, folder, top, debug):
+    '"main_async()" runs the "main()" process on many images concurrently'
+
+    # Vision calls share 1 multiplexed gRPC channel; blocking Drive, GCS &
+    # Sheets calls run in a pool of threads, each with its own clients
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(futures.ThreadPoolExecutor(THREADS))
+    client = vision.ImageAnnotatorAsyncClient()
+    inflight = asyncio.Semaphore(INFLIGHT)
+
+    async def process(fname):
+        async with inflight:
+            # download img file & info from Drive
+            rsp = await loop.run_in_executor(None, drive_get_img, fname)
+            if not rsp:
+                return
+            fname, mtype, ftime, data = rsp
+            if debug:
+                print('Downloaded %r (%s, %s, size: %d)' % (
+                        fname, mtype, ftime, len(data)))
+
+            # upload file to GCS while Vision processes it
+            gcsname = '%s/%s'% (folder, fname)
+            rsp, labels = await asyncio.gather(
+                    loop.run_in_executor(None,
+                            gcs_blob_upload, gcsname, bucket, data, mtype),
+                    vision_label_img_async(client, data, top))
+            if not (rsp and labels):
+                return
+            if debug:
+                print('Uploaded %r to GCS bucket %r' % (rsp['name'], rsp['bucket']))
+                print('Top %d labels from Vision API: %s' % (top, labels))
+
+            # push results to Sheet, get cells-saved count
+            fsize = k_ize(len(data))
+            row = [folder,
+                    '=HYPERLINK("storage.cloud.google.com/%s/%s", "%s")' % (
+                    bucket, gcsname, fname), mtype, ftime, fsize, labels
+            ]
+            rsp = await loop.run_in_executor(None, sheet_append_row, sheet_id, row)
+            if not rsp:
+                return
+            if debug:
+                print('Added %d cells to Google Sheet' % rsp)
+            return True
+
+    # report any failures, return #images processed
+    rsps = await asyncio.gather(*(process(fname) for fname in fnames),
+            return_exceptions=True)
+    for fname, rsp in zip(fnames, rsps):
+        if rsp is not True:
+            print('ERROR: could not process %r%s' % (fname,
+                    ': %s' % rsp if isinstance(rsp, Exception) else ''))
+    return sum(rsp is True for rsp in rsps)
+
+
 if __name__ == '__main__':
     # args: [-hv] [-i imgfile] [-b bucket] [-f folder] [-s Sheet ID] [-t top labels]
+    #       [-a [imgfile ...]]
     parser = argparse.ArgumentParser()
     parser.add_argument("-i", "--imgfile", action="store_true",
             default=FILE, help="image file filename")
@@ -172,14 +351,25 @@ if __name__ == '__main__':
             default=TOP, help="return top N (default %d) Vision API labels" % TOP)
     parser.add_argument("-v", "--verbose", action="store_true",
             default=DEBUG, help="verbose display output")
+    parser.add_argument("-a", "--aio", action="store_true",
+            help="process image files concurrently with asyncio")
+    parser.add_argument("imgfiles", nargs="*",
+            help="with -a, image file filenames (instead of -i)")
     args = parser.parse_args()
 
-    print('Processing file %r... please wait' % args.imgfile)
-    rsp = main(args.imgfile, args.bucket_id,
-            args.sheet_id, args.folder, args.viz_top, args.verbose)
+    if args.aio:
+        fnames = args.imgfiles or [args.imgfile]
+        print('Processing %d file(s)... please wait' % len(fnames))
+        rsp = asyncio.run(main_async(fnames, args.bucket_id,
+                args.sheet_id, args.folder, args.viz_top, args.verbose))
+        print('Processed %d of %d file(s)' % (rsp, len(fnames)))
+    else:
+        print('Processing file %r... please wait' % args.imgfile)
+        rsp = main(args.imgfile, args.bucket_id,
+                args.sheet_id, args.folder, args.viz_top, args.verbose)
     if rsp:
         sheet_url = 'https://docs.google.com/spreadsheets/d/%s/edit' % args.sheet_id
         print('DONE: opening web browser to it, or see %s' % sheet_url)
         webbrowser.open(sheet_url, new=1, autoraise=True)
-    else:
+    elif not args.aio:
         print('ERROR: could not process %r' % args.imgfile)
@@ -22,11 +22,17 @@ to Google Cloud Vision for processing, add results row to Google Sheet.
 from __future__ import print_function
 import argparse
 import base64
+import collections
 import io
+import threading
+import time
 import webbrowser
 
-from googleapiclient import discovery, http
+from googleapiclient import discovery, errors, http
 import google.auth
+from google.oauth2 import service_account
+import google_auth_httplib2
+import httplib2
 
 k_ize = lambda b: '%6.2fK' % (b/1000.) # bytes to kBs
 FILE = 'YOUR_IMG_ON_DRIVE'
@@ -36,21 +42,164 @@ SHEET = 'YOUR_SHEET_ID'
 TOP = 5       # TOP # of VISION LABELS TO SAVE
 DEBUG = False
 
-# create API service endpoints
-creds, _proj_id = google.auth.default()
-DRIVE  = discovery.build('drive',   'v3', credentials=creds)
-GCS    = discovery.build('storage', 'v1', credentials=creds)
-VISION = discovery.build('vision',  'v1', credentials=creds)
-SHEETS = discovery.build('sheets',  'v4', credentials=creds)
+# svc acct credential pool
+SVC_KEYS = ()   # SVC ACCT JSON KEY FILES TO POOL (default creds if empty)
+RATE_REST = 60      # SECS TO REST A CREDENTIAL'S API AFTER A RATE LIMIT
+QUOTA_REST = 3600   # SECS TO REST A CREDENTIAL'S API AFTER ITS QUOTA RUNS OUT
+SCOPES = (
+    'https://www.googleapis.com/auth/drive.readonly',
+    'https://www.googleapis.com/auth/devstorage.full_control',
+    'https://www.googleapis.com/auth/cloud-vision',
+    'https://www.googleapis.com/auth/spreadsheets',
+)
+RATE_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded',
+        'RESOURCE_EXHAUSTED')   # (LIKE ALL 429s) REST Retry-After OR RATE_REST SECS
+QUOTA_REASONS = ('dailyLimitExceeded',)  # (LIKE 'per day' LIMITS) REST QUOTA_REST
+
+# "users" mode: domain-wide delegation
+THREADS = 16        # WORKER THREADS SHARED BY ALL USERS
+USER_INFLIGHT = 4   # MAX CRAWLS & IMAGES IN FLIGHT PER USER
+DWD_SCOPES = ('https://www.googleapis.com/auth/drive.readonly',)
+
+
+def svc_apis(key):
+    'create API service endpoints for svc acct key file (default creds if None)'
+    if key:
+        creds = service_account.Credentials.from_service_account_file(
+                key, scopes=SCOPES)
+    else:
+        creds, _proj_id = google.auth.default()
+    return {
+        'drive':   discovery.build('drive',   'v3', credentials=creds),
+        'storage': discovery.build('storage', 'v1', credentials=creds),
+        'vision':  discovery.build('vision',  'v1', credentials=creds),
+        'sheets':  discovery.build('sheets',  'v4', credentials=creds),
+    }
+
+
+def user_creds(key, user):
+    'create credentials impersonating user (domain-wide delegation)'
+    return service_account.Credentials.from_service_account_file(
+            key, scopes=DWD_SCOPES, subject=user)
+
+
+def user_execute(req, creds, conn):
+    'execute API request as user (creds) over unauthorized connection'
+    if not creds.valid:
+        creds.refresh(google_auth_httplib2.Request(conn))
+    creds.apply(req.headers)
+    return req.execute(http=conn)
+
+
+def quota_rest(err):
+    'return secs to rest a credential if err is a rate/quota error, else None'
+    if not isinstance(err, errors.HttpError):
+        return
+    content = err.content.decode('utf-8', 'replace') \
+            if isinstance(err.content, bytes) else str(err.content)
+    return rest_secs(err.resp.status, content, err.resp.get('retry-after', ''))
+
+
+def rest_secs(status, content, retry_after):
+    'return secs to rest a credential after error status/content, else None'
+    if any(reason in content for reason in QUOTA_REASONS):
+        return QUOTA_REST
+    if status == 429 or any(reason in content for reason in RATE_REASONS):
+        if 'per day' in content.lower():
+            return QUOTA_REST
+        return int(retry_after) if retry_after.isdigit() else RATE_REST
+
+
+class QuotaExhausted(Exception):
+    'every pooled credential is out of quota for an API'
+
+
+class CredentialPool(object):
+    'spread API calls across svc accts/projects, routing around exhausted ones'
+
+    def __init__(self, keys):
+        self.keys = list(keys) or [None]
+        self.lock = threading.Lock()
+        self.last = {}      # per API: last rate/quota error seen
+        self.members = []   # built on first call
+
+    def pick(self, api):
+        'reserve least-loaded credential with API quota left, else secs to wait'
+        with self.lock:
+            if not self.members:
+                self.members = [{
+                    'name':   key or 'default',
+                    'key':    key,
+                    'local':  threading.local(),        # per-thread API endpoints
+                    'busy':   0,                            # calls in flight
+                    'calls':  collections.Counter(),        # per API
+                    'errors': collections.Counter(),        # per API
+                    'rests':  collections.Counter(),        # per API
+                    'until':  collections.defaultdict(int), # per API: resting until
+                    'spent':  collections.defaultdict(bool),    # per API: quota out
+                } for key in self.keys]
+            now = time.time()
+            ready = [m for m in self.members if m['until'][api] <= now]
+            if not ready:
+                return None, min(m['until'][api] for m in self.members) - now
+            member = min(ready, key=lambda m: (m['busy'], m['calls'][api]))
+            member['busy'] += 1
+            member['calls'][api] += 1
+            return member, 0
+
+    @staticmethod
+    def apis(member):
+        'API service endpoints of pooled credential for calling thread'
+        local = member['local']
+        if not hasattr(local, 'apis'):
+            local.apis = svc_apis(member['key'])
+        return local.apis
+
+    def call(self, api, make_req):
+        'run make_req(API endpoint) on a pooled credential, retrying elsewhere'
+        while True:
+            member, wait = self.pick(api)
+            if not member:
+                if all(m['spent'][api] for m in self.members):  # all out of quota
+                    raise QuotaExhausted('%s: %s' % (api, self.last[api]))
+                time.sleep(wait)
+                continue
+            try:
+                return make_req(self.apis(member)[api])
+            except Exception as e:
+                secs = quota_rest(e)
+                with self.lock:
+                    member['errors'][api] += 1
+                    if secs:
+                        member['rests'][api] += 1
+                        member['until'][api] = time.time() + secs
+                        member['spent'][api] = secs >= QUOTA_REST
+                        self.last[api] = e
+                if not secs:
+                    raise
+            finally:
+                with self.lock:
+                    member['busy'] -= 1
+
+    def report(self):
+        'return per-credential call, error & rest counts as display lines'
+        return ['%s: %s' % (m['name'], ', '.join(
+                '%s %d calls/%d errors/%d rests' % (api,
+                m['calls'][api], m['errors'][api], m['rests'][api])
+                for api in sorted(m['calls']))) for m in self.members]
+
+
+# create API service endpoints (one set per pooled credential)
+POOL = CredentialPool(SVC_KEYS)
 
 
 def drive_get_img(fname):
     'download file from Drive and return file info & binary if found'
 
     # search for file on Google Drive
-    rsp = DRIVE.files().list(q="name='%s'" % fname,
-            fields='files(id,name,mimeType,modifiedTime)'
-    ).execute().get('files', [])
+    rsp = POOL.call('drive', lambda drive: drive.files().list(
+            q="name='%s'" % fname, fields='files(id,name,mimeType,modifiedTime)'
+    ).execute()).get('files', [])
 
     # download binary & return file info if found, else return None
     if rsp:
@@ -58,7 +207,8 @@ def drive_get_img(fname):
         fileId = target['id']
         fname = target['name']
         mtype = target['mimeType']
-        binary = DRIVE.files().get_media(fileId=fileId).execute()
+        binary = POOL.call('drive', lambda drive:
+                drive.files().get_media(fileId=fileId).execute())
         return fname, mtype, target['modifiedTime'], binary
 
 
@@ -67,9 +217,10 @@ def gcs_blob_upload(fname, bucket, media, mimetype):
 
     # build blob metadata and upload via GCS API
     body = {'name': fname, 'uploadType': 'multipart', 'contentType': mimetype}
-    return GCS.objects().insert(bucket=bucket, body=body,
+    return POOL.call('storage', lambda gcs: gcs.objects().insert(
+            bucket=bucket, body=body,
             media_body=http.MediaIoBaseUpload(io.BytesIO(media), mimetype),
-            fields='bucket,name').execute()
+            fields='bucket,name').execute())
 
 
 def vision_label_img(img, top):
@@ -80,7 +231,8 @@ def vision_label_img(img, top):
                 'image':     {'content': img},
                 'features': [{'type': 'LABEL_DETECTION', 'maxResults': top}],
     }]}
-    rsp = VISION.images().annotate(body=body).execute().get('responses', [{}])[0]
+    rsp = POOL.call('vision', lambda viz: viz.images().annotate(body=body).execute()
+            ).get('responses', [{}])[0]
 
     # return top labels for image as CSV for Sheet (row)
     if 'labelAnnotations' in rsp:
@@ -93,10 +245,10 @@ def sheet_append_row(sheet, row):
     'append row to a Google Sheet, return #cells added'
 
     # call Sheets API to write row to Sheet (via its ID)
-    rsp = SHEETS.spreadsheets().values().append(
+    rsp = POOL.call('sheets', lambda sheets: sheets.spreadsheets().values().append(
             spreadsheetId=sheet, range='Sheet1',
             valueInputOption='USER_ENTERED', body={'values': [row]}
-    ).execute()
+    ).execute())
     if rsp:
         return rsp.get('updates').get('updatedCells')
 
@@ -141,8 +293,186 @@ def main(fname, bucket, sheet_id, folder, top, debug):
     return True
 
 
+class FairShare(object):
+    'share worker threads fairly across users, 1 crawl or image at a time'
+
+    def __init__(self, key, users):
+        self.key = key
+        self.cond = threading.Condition()
+        self.turn = 0       # user offered the next free worker first
+        self.seen = {}      # shared by all users: md5Checksum: (GCS name, labels)
+        self.local = threading.local()  # per-thread Drive endpoint (all users)
+        self.users = [{
+            'user':     user,
+            'creds':    None,                   # delegated (on 1st call)
+            'todo':     collections.deque(),    # crawled images to process
+            'page':     '',                     # next listing page (None: done)
+            'crawling': False,
+            'busy':     0,                      # tasks in flight
+            'until':    0,                      # resting until (Drive quota)
+            'stats':    collections.Counter(),  # API calls, images, errors...
+        } for user in users]
+
+    def drive(self, user, make_req):
+        'execute Drive API request make_req(endpoint) impersonating user'
+
+        # 1 endpoint (& connection) per thread, not per user & thread,
+        # authorizing each request with user's (cached) credentials
+        local = self.local
+        if not hasattr(local, 'drive'):
+            local.conn = httplib2.Http()
+            local.drive = discovery.build('drive', 'v3', http=local.conn)
+        with self.cond:
+            if not user['creds']:
+                user['creds'] = user_creds(self.key, user['user'])
+        return user_execute(make_req(local.drive), user['creds'], local.conn)
+
+    def count(self, user, stat, n=1):
+        'add to per-user accounting'
+        with self.cond:
+            user['stats'][stat] += n
+
+    def next(self):
+        'wait for next (user, task) in turn (task: image, or None to crawl)'
+        with self.cond:
+            while True:
+                now, waits, live = time.time(), [], False
+                for i in range(len(self.users)):
+                    user = self.users[(self.turn + i) % len(self.users)]
+                    if user['todo'] or user['page'] is not None or user['busy']:
+                        live = True
+                    if user['busy'] >= USER_INFLIGHT:
+                        continue
+                    if user['until'] > now:
+                        waits.append(user['until'] - now)
+                        continue
+                    # crawl ahead so user's images don't run dry b/w pages
+                    if user['page'] is not None and not user['crawling'] \
+                            and len(user['todo']) < USER_INFLIGHT:
+                        user['crawling'], task = True, None
+                    elif user['todo']:
+                        task = user['todo'].popleft()
+                    else:
+                        continue
+                    user['busy'] += 1
+                    self.turn = (self.turn + i + 1) % len(self.users)
+                    return user, task
+                if not live:
+                    return None, None
+                self.cond.wait(min(waits) if waits else None)
+
+    def done(self, user, task, err=None):
+        'finish user task; on Drive quota error rest user & retry task later'
+        secs = err and quota_rest(err)
+        with self.cond:
+            user['busy'] -= 1
+            if task is None:
+                user['crawling'] = False
+            if err:
+                user['stats']['errors'] += 1
+                if secs:
+                    user['stats']['rests'] += 1
+                    user['until'] = time.time() + secs
+                    if task:
+                        user['todo'].appendleft(task)
+                else:
+                    if task is None:    # can't list user's Drive: skip user
+                        user['page'] = None
+                    print('WARNING: %s: %s' % (user['user'], err))
+            self.cond.notify_all()
+
+    def report(self):
+        'return per-user accounting as display lines'
+        return ['%s: %s' % (user['user'], ', '.join('%s %d' % stat
+                for stat in sorted(user['stats'].items())))
+                for user in self.users]
+
+
+def user_crawl(share, user):
+    'list next page of images owned by user to process'
+    share.count(user, 'drive')
+    rsp = share.drive(user, lambda drive: drive.files().list(
+            q="'me' in owners and mimeType contains 'image/' and trashed=false",
+            fields='nextPageToken,'
+                    'files(id,name,mimeType,modifiedTime,size,md5Checksum)',
+            pageSize=1000, pageToken=user['page'] or None))
+    with share.cond:
+        user['todo'].extend(rsp.get('files', []))
+        user['page'] = rsp.get('nextPageToken')
+
+
+def user_process(share, user, target, bucket, sheet_id, folder, top):
+    'archive & label 1 image from user\'s Drive, add its row to Sheet'
+    folder = '%s/%s' % (folder, user['user']) if folder else user['user']
+    md5 = target.get('md5Checksum')
+    with share.cond:
+        seen = share.seen.get(md5)
+    if seen:    # same image already in another user's Drive
+        gcsname, rsp = seen
+        share.count(user, 'dupes')
+    else:
+        share.count(user, 'drive')
+        data = share.drive(user, lambda drive:
+                drive.files().get_media(fileId=target['id']))
+        share.count(user, 'bytes', len(data))
+        gcsname = '%s/%s' % (folder, target['name'])
+        share.count(user, 'storage')
+        if not gcs_blob_upload(gcsname, bucket, data, target['mimeType']):
+            return
+        share.count(user, 'vision')
+        rsp = vision_label_img(base64.b64encode(data).decode('utf-8'), top)
+        if not rsp:
+            return
+        if md5:
+            with share.cond:
+                share.seen[md5] = gcsname, rsp
+
+    # push results to Sheet
+    row = [folder,
+            '=HYPERLINK("storage.cloud.google.com/%s/%s", "%s")' % (
+            bucket, gcsname, target['name']), target['mimeType'],
+            target['modifiedTime'], k_ize(int(target.get('size', 0))), rsp
+    ]
+    share.count(user, 'sheets')
+    if sheet_append_row(sheet_id, row):
+        share.count(user, 'images')
+
+
+def user_worker(share, bucket, sheet_id, folder, top):
+    'run users\' crawls & images, in turn, until all are done'
+    while True:
+        user, task = share.next()
+        if not user:
+            return
+        try:
+            if task is None:
+                user_crawl(share, user)
+            else:
+                user_process(share, user, task, bucket, sheet_id, folder, top)
+        except Exception as e:
+            share.done(user, task, e)
+        else:
+            share.done(user, task)
+
+
+def users_main(users, bucket, sheet_id, folder, top, debug):
+    '"users" mode: archive & label images in many users\' Drives at once'
+    share = FairShare(POOL.keys[0], users)
+    threads = [threading.Thread(target=user_worker,
+            args=(share, bucket, sheet_id, folder, top)) for _ in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if debug:
+        print('\n'.join(share.report()))
+    return sum(user['stats']['images'] for user in share.users)
+
+
+
 if __name__ == '__main__':
     # args: [-hv] [-i imgfile] [-b bucket] [-f folder] [-s Sheet ID] [-t top labels]
+    #       [-k svc acct key files...] [-u user list file]
     parser = argparse.ArgumentParser()
     parser.add_argument("-i", "--imgfile", action="store_true",
             default=FILE, help="image file filename")
@@ -156,14 +486,32 @@ if __name__ == '__main__':
             default=TOP, help="return top N (default %d) Vision API labels" % TOP)
     parser.add_argument("-v", "--verbose", action="store_true",
             default=DEBUG, help="verbose display output")
+    parser.add_argument("-k", "--svc_keys", nargs='+', default=SVC_KEYS,
+            help="pool calls across these svc acct JSON key files")
+    parser.add_argument("-u", "--users", metavar="USERFILE",
+            help="process images in Drives of users listed (1 email/line) "
+                 "via domain-wide delegation")
     args = parser.parse_args()
+    if tuple(args.svc_keys) != SVC_KEYS:
+        POOL = CredentialPool(args.svc_keys)
+    if args.users and not POOL.keys[0]:
+        parser.error('-u needs svc acct key file (-k) w/domain-wide delegation')
 
-    print('Processing file %r... please wait' % args.imgfile)
-    rsp = main(args.imgfile, args.bucket_id,
-            args.sheet_id, args.folder, args.viz_top, args.verbose)
+    if args.users:
+        with open(args.users) as f:
+            users = [line.strip() for line in f if line.strip()]
+        print('Processing images of %d users... please wait' % len(users))
+        rsp = users_main(users, args.bucket_id,
+                args.sheet_id, args.folder, args.viz_top, args.verbose)
+    else:
+        print('Processing file %r... please wait' % args.imgfile)
+        rsp = main(args.imgfile, args.bucket_id,
+                args.sheet_id, args.folder, args.viz_top, args.verbose)
+    if args.verbose:
+        print('\n'.join(POOL.report()))
     if rsp:
         sheet_url = 'https://docs.google.com/spreadsheets/d/%s/edit' % args.sheet_id
         print('DONE: opening web browser to it, or see %s' % sheet_url)
         webbrowser.open(sheet_url, new=1, autoraise=True)
     else:
-        print('ERROR: could not process %r' % args.imgfile)
+        print('ERROR: could not process %r' % (args.users or args.imgfile))
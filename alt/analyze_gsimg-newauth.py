@@ -22,9 +22,17 @@ to Google Cloud Vision for processing, add results row to Google Sheet.
 from __future__ import print_function
 import argparse
 import base64
+import contextlib
+import datetime
 import io
 import os
+import threading
+import time
 import webbrowser
+try:
+    import fcntl    # POSIX-only: share token storage across processes
+except ImportError:
+    fcntl = None
 
 from googleapiclient import discovery, http
 from google_auth_oauthlib.flow import InstalledAppFlow
@@ -42,23 +50,103 @@ DEBUG = False
 # process credentials for OAuth2 tokens
 creds = None
 TOKENS = 'tokens.json' # OAuth2 token storage
+REFRESH_AHEAD = 300    # SECS BEFORE EXPIRY TO REFRESH TOKENS
+REFRESH_RETRY = 30     # SECS BETWEEN FAILED REFRESH ATTEMPTS
 SCOPES = (
     'https://www.googleapis.com/auth/drive.readonly',
     'https://www.googleapis.com/auth/devstorage.full_control',
     'https://www.googleapis.com/auth/cloud-vision',
     'https://www.googleapis.com/auth/spreadsheets',
 )
-if os.path.exists(TOKENS):
-    creds = credentials.Credentials.from_authorized_user_file(TOKENS)
-if not (creds and creds.valid):
-    if creds and creds.expired and creds.refresh_token:
-        creds.refresh(Request())
-    else:
-        flow = InstalledAppFlow.from_client_secrets_file(
-                'client_secret.json', SCOPES)
-        creds = flow.run_local_server()
-    with open(TOKENS, 'w') as token:
+
+
+@contextlib.contextmanager
+def tokens_lock():
+    'hold exclusive lock on OAuth2 token storage across worker processes'
+    with open(TOKENS + '.lock', 'a') as lock:
+        if fcntl:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def save_tokens(creds):
+    'atomically (re)write OAuth2 token storage (call with tokens_lock() held)'
+    tmp = '%s.%d' % (TOKENS, os.getpid())
+    with open(tmp, 'w') as token:
         token.write(creds.to_json())
+    # os.replace() is Python 3 only; on POSIX, os.rename() also replaces
+    getattr(os, 'replace', os.rename)(tmp, TOKENS)
+
+
+class TokenManager(object):
+    'refresh OAuth2 tokens ahead of expiry, once for all threads & processes'
+
+    def __init__(self, creds):
+        self.creds = creds
+        self._lock = threading.Lock()
+        # route inline refreshes (expired token, HTTP 401) through here too
+        self._refresh = creds.refresh
+        creds.refresh = self.refresh
+
+    def refresh(self, request=None):
+        'single-flight refresh: adopt tokens refreshed elsewhere or refresh & save'
+        seen = self.creds.token
+        with self._lock:
+            if self.creds.token != seen:    # another thread just refreshed
+                return
+            with tokens_lock():
+                # another process may have refreshed & saved newer tokens
+                if os.path.exists(TOKENS):
+                    saved = credentials.Credentials.from_authorized_user_file(TOKENS)
+                    if saved.token != seen and (self.secs_left(saved) or 0) > REFRESH_AHEAD:
+                        self.creds.token = saved.token
+                        self.creds.expiry = saved.expiry
+                        return
+                self._refresh(request or Request())
+                save_tokens(self.creds)
+
+    @staticmethod
+    def secs_left(creds):
+        'return seconds until access token expires (None if no expiry)'
+        if creds.expiry:
+            return (creds.expiry - datetime.datetime.utcnow()).total_seconds()
+
+    def start(self):
+        'start background thread refreshing tokens before they expire'
+        thread = threading.Thread(target=self._run, name='TokenManager')
+        thread.daemon = True
+        thread.start()
+
+    def _run(self):
+        while self.creds.refresh_token:
+            wait = self.secs_left(self.creds)
+            wait = REFRESH_AHEAD if wait is None else wait - REFRESH_AHEAD
+            if wait > 0:
+                time.sleep(wait)
+                continue
+            try:
+                self.refresh()
+            except Exception as e:  # retry; inline refresh still a fallback
+                print('WARNING: OAuth2 token refresh failed: %s' % e)
+                time.sleep(REFRESH_RETRY)
+
+
+with tokens_lock():
+    if os.path.exists(TOKENS):
+        creds = credentials.Credentials.from_authorized_user_file(TOKENS)
+    if not (creds and creds.valid):
+        if creds and creds.expired and creds.refresh_token:
+            creds.refresh(Request())
+        else:
+            flow = InstalledAppFlow.from_client_secrets_file(
+                    'client_secret.json', SCOPES)
+            creds = flow.run_local_server()
+        save_tokens(creds)
+TokenManager(creds).start()
 
 # create API service endpoints
 DRIVE  = discovery.build('drive',   'v3', credentials=creds)
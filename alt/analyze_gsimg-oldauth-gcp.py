@@ -21,7 +21,10 @@ to Google Cloud Vision for processing, add results row to Google Sheet.
 
 from __future__ import print_function
 import argparse
+import asyncio
+import threading
 import webbrowser
+from concurrent import futures
 
 from googleapiclient import discovery
 from httplib2 import Http
@@ -35,6 +38,8 @@ PARENT = ''     # YOUR IMG FILE PREFIX
 SHEET = 'YOUR_SHEET_ID'
 TOP = 5       # TOP # of VISION LABELS TO SAVE
 DEBUG = False
+INFLIGHT = 200  # MAX IMAGES IN FLIGHT AT ONCE (async mode)
+THREADS = 32    # THREADS FOR BLOCKING DRIVE, GCS & SHEETS CALLS (async mode)
 
 # process credentials for OAuth2 tokens
 SCOPES = (
@@ -49,12 +54,27 @@ if not creds or creds.invalid:
     flow = client.flow_from_clientsecrets('client_secret.json', SCOPES)
     creds = tools.run_flow(flow, store)
 
-# create API service endpoints
-HTTP = creds.authorize(Http())
-DRIVE  = discovery.build('drive',   'v3', http=HTTP)
-GCS    = storage.Client()
+# create API service endpoints (one per thread if not thread-safe)
+class ThreadLocal(object):
+    'per-thread API client, built on first use in each thread'
+
+    def __init__(self, build):
+        self._build = build
+        self._local = threading.local()
+
+    def __getattr__(self, name):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self._build()
+        return getattr(client, name)
+
+
+DRIVE  = ThreadLocal(lambda: discovery.build('drive',  'v3',
+        http=creds.authorize(Http())))
+GCS    = ThreadLocal(storage.Client)
 VISION = vision.ImageAnnotatorClient()
-SHEETS = discovery.build('sheets',  'v4', http=HTTP)
+SHEETS = ThreadLocal(lambda: discovery.build('sheets', 'v4',
+        http=creds.authorize(Http())))
 
 
 def drive_get_img(fname):
@@ -88,7 +108,7 @@ def vision_label_img(img, top):
     'send image to Vision API for label annotation'
 
     # call Vision API to process
-    image = vision.types.Image(content=img)
+    image = vision.Image(content=img)
     labels = VISION.label_detection(image=image, max_results=top).label_annotations
 
     # return top labels for image as CSV for Sheet (row)
@@ -96,6 +116,22 @@ def vision_label_img(img, top):
             label.score*100., label.description) for label in labels)
 
 
+async def vision_label_img_async(client, img, top):
+    'send image to Vision API (async client) for label annotation'
+
+    # call Vision API to process
+    rsp = await client.batch_annotate_images(requests=[{
+            'image':    {'content': img},
+            'features': [{'type_': vision.Feature.Type.LABEL_DETECTION,
+                    'max_results': top}],
+    }])
+    labels = rsp.responses[0].label_annotations
+
+    # return top labels for image as CSV for Sheet (row)
+    return ', '.join('(%.2f%%) %s' % (
+            label.score*100., label.description) for label in labels)
+
+
 def sheet_append_row(sheet, row):
     'append row to a Google Sheet, return #cells added'
 
@@ -148,8 +184,65 @@ def main(fname, bucket, sheet_id, folder, top, debug):
     return True
 
 
+async def main_async(fnames, bucket, sheet_id, folder, top, debug):
+    '"main_async()" runs the "main()" process on many images concurrently'
+
+    # Vision calls share 1 multiplexed gRPC channel; blocking Drive, GCS &
+    # Sheets calls run in a pool of threads, each with its own clients
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(futures.ThreadPoolExecutor(THREADS))
+    client = vision.ImageAnnotatorAsyncClient()
+    inflight = asyncio.Semaphore(INFLIGHT)
+
+    async def process(fname):
+        async with inflight:
+            # download img file & info from Drive
+            rsp = await loop.run_in_executor(None, drive_get_img, fname)
+            if not rsp:
+                return
+            fname, mtype, ftime, data = rsp
+            if debug:
+                print('Downloaded %r (%s, %s, size: %d)' % (
+                        fname, mtype, ftime, len(data)))
+
+            # upload file to GCS while Vision processes it
+            gcsname = '%s/%s'% (folder, fname)
+            rsp, labels = await asyncio.gather(
+                    loop.run_in_executor(None,
+                            gcs_blob_upload, gcsname, bucket, data, mtype),
+                    vision_label_img_async(client, data, top))
+            if not (rsp and labels):
+                return
+            if debug:
+                print('Uploaded %r to GCS bucket %r' % (rsp['name'], rsp['bucket']))
+                print('Top %d labels from Vision API: %s' % (top, labels))
+
+            # push results to Sheet, get cells-saved count
+            fsize = k_ize(len(data))
+            row = [folder,
+                    '=HYPERLINK("storage.cloud.google.com/%s/%s", "%s")' % (
+                    bucket, gcsname, fname), mtype, ftime, fsize, labels
+            ]
+            rsp = await loop.run_in_executor(None, sheet_append_row, sheet_id, row)
+            if not rsp:
+                return
+            if debug:
+                print('Added %d cells to Google Sheet' % rsp)
+            return True
+
+    # report any failures, return #images processed
+    rsps = await asyncio.gather(*(process(fname) for fname in fnames),
+            return_exceptions=True)
+    for fname, rsp in zip(fnames, rsps):
+        if rsp is not True:
+            print('ERROR: could not process %r%s' % (fname,
+                    ': %s' % rsp if isinstance(rsp, Exception) else ''))
+    return sum(rsp is True for rsp in rsps)
+
+
 if __name__ == '__main__':
     # args: [-hv] [-i imgfile] [-b bucket] [-f folder] [-s Sheet ID] [-t top labels]
+    #       [-a [imgfile ...]]
     parser = argparse.ArgumentParser()
     parser.add_argument("-i", "--imgfile", action="store_true",
             default=FILE, help="image file filename")
@@ -163,14 +256,25 @@ if __name__ == '__main__':
             default=TOP, help="return top N (default %d) Vision API labels" % TOP)
     parser.add_argument("-v", "--verbose", action="store_true",
             default=DEBUG, help="verbose display output")
+    parser.add_argument("-a", "--aio", action="store_true",
+            help="process image files concurrently with asyncio")
+    parser.add_argument("imgfiles", nargs="*",
+            help="with -a, image file filenames (instead of -i)")
     args = parser.parse_args()
 
-    print('Processing file %r... please wait' % args.imgfile)
-    rsp = main(args.imgfile, args.bucket_id,
-            args.sheet_id, args.folder, args.viz_top, args.verbose)
+    if args.aio:
+        fnames = args.imgfiles or [args.imgfile]
+        print('Processing %d file(s)... please wait' % len(fnames))
+        rsp = asyncio.run(main_async(fnames, args.bucket_id,
+                args.sheet_id, args.folder, args.viz_top, args.verbose))
+        print('Processed %d of %d file(s)' % (rsp, len(fnames)))
+    else:
+        print('Processing file %r... please wait' % args.imgfile)
+        rsp = main(args.imgfile, args.bucket_id,
+                args.sheet_id, args.folder, args.viz_top, args.verbose)
     if rsp:
         sheet_url = 'https://docs.google.com/spreadsheets/d/%s/edit' % args.sheet_id
         print('DONE: opening web browser to it, or see %s' % sheet_url)
         webbrowser.open(sheet_url, new=1, autoraise=True)
-    else:
+    elif not args.aio:
         print('ERROR: could not process %r' % args.imgfile)
@@ -22,20 +22,123 @@ to Google Cloud Vision for processing, add results row to Google Sheet.
 from __future__ import print_function
 import argparse
 import base64
+import collections
+import functools
+import glob
+import gzip
+import hashlib
 import io
+import json
+import mmap
+import os
+import re
+import socket
+import sqlite3
+import struct
+import sys
+import tempfile
+import threading
+import time
+import uuid
 import webbrowser
+from concurrent import futures
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    import queue
+    from urllib.parse import quote
+except ImportError:     # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    import Queue as queue
+    from urllib import quote
 
-from googleapiclient import discovery, http
-from httplib2 import Http
+from googleapiclient import discovery, errors, http
+try:    # optional: only needed for near-duplicate detection (--phash)
+    import numpy
+    from PIL import Image
+except ImportError:
+    numpy = Image = None
+try:    # optional: only needed for label search index (--index, query)
+    import pyarrow
+    import pyarrow.compute
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+try:    # optional: faster CRC32C checks of composite uploads (--composite)
+    import google_crc32c
+except ImportError:
+    google_crc32c = None
+try:    # optional: only needed for HTTP/2 transport (--http2)
+    import h2       # httpx's HTTP/2 support
+    import httpx
+except ImportError:
+    httpx = None
+from httplib2 import Http, Response
 from oauth2client import file, client, tools
 
 k_ize = lambda b: '%6.2fK' % (b/1000.) # bytes to kBs
 FILE = 'YOUR_IMG_ON_DRIVE'
 BUCKET = 'YOUR_BUCKET_NAME'
 PARENT = ''     # YOUR IMG FILE PREFIX
+FOLDER_ID = ''  # YOUR DRIVE FOLDER ID (process all its images)
 SHEET = 'YOUR_SHEET_ID'
 TOP = 5       # TOP # of VISION LABELS TO SAVE
+FEATURES = ('labels',)  # VISION FEATURES TO SAVE (see VISION_FEATURES)
 DEBUG = False
+LEASE = 600     # SECS A QUEUE WORKER HOLDS AN IMAGE BEFORE OTHERS MAY TAKE IT
+MAX_TRIES = 3   # MAX ATTEMPTS PER QUEUED IMAGE
+MAX_JOBS = 10000  # MAX SERVICE-MODE JOB RESULTS KEPT
+BATCH_IMGS = 2000 # MAX IMAGES PER VISION asyncBatchAnnotate OPERATION
+BATCH_OUT = 100   # VISION RESPONSES PER (BACKFILL) OUTPUT FILE
+BATCH_OPS = 8     # MAX VISION BATCH OPERATIONS RUNNING AT ONCE
+BATCH_POLL = 15   # SECS BETWEEN VISION BATCH OPERATION STATUS CHECKS
+SHEET_ROWS = 500  # MAX ROWS PER SHEETS APPEND (bulk loads)
+B64_CHUNK = 3 << 16  # IMAGE BYTES BASE64-ENCODED AT A TIME (multiple of 3)
+HEDGE_PCT = 5     # MAX % EXTRA (HEDGED) REQUESTS, IF HEDGING
+HEDGE_DELAY = 1.  # SECS BEFORE HEDGING UNTIL p95 LATENCY KNOWN
+HEDGE_SAMPLES = 200  # LATENCIES KEPT PER API CALL FOR p95
+HEDGER = None     # Hedger FOR IDEMPOTENT CALLS (set by --hedge)
+BREAKER_PCT = 50  # % FAILED RECENT CALLS TO AN API THAT OPENS ITS CIRCUIT
+BREAKER_CALLS = 10  # MIN RECENT CALLS BEFORE A CIRCUIT CAN OPEN
+BREAKER_WAIT = 30 # SECS A CIRCUIT STAYS OPEN BEFORE A PROBE CALL IS LET THROUGH
+WORKERS = 1       # IMAGES PROCESSED AT ONCE (batch mode)
+ORDER = 'fifo'    # ORDER IMAGES START IN (batch mode, see Scheduler)
+BIG_IMG = 16 << 20  # IMAGES THIS BIG (BYTES) OR MORE ARE "BIG"
+BIG_PCT = 25      # MAX % OF WORKERS ON BIG IMAGES AT ONCE
+WAL_SYNC = 20     # PENDING SHEET ROWS LOGGED BETWEEN fsyncs
+WAL_AGE = 60      # MAX SECS A ROW WAITS FOR A BULK SHEET APPEND
+ROWS = None       # RowBuffer FOR BULK SHEET APPENDS (set by --wal)
+PHASH_DIST = 6    # MAX BITS (OF 64) DIFFERING IN NEAR-DUPLICATE IMAGES' HASHES
+PHASHES = None    # BKTree OF LABELED IMAGES' HASHES (set by --phash)
+SPILL_SIZE = 32 << 20  # IMAGES BIGGER THAN THIS (BYTES) ARE SPILLED TO DISK
+SPILL_DIR = None  # DIR FOR SPILLED IMAGES (None: system temp dir)
+VISION_MAX = 7 << 20  # BIGGEST IMAGE (BYTES) SENT TO VISION AS IS (10MB requests)
+VISION_PX = 2048  # MAX WIDTH/HEIGHT (PIXELS) OF IMAGES SHRUNK FOR VISION
+DL_CHUNK = 8 << 20  # BYTES DOWNLOADED FROM DRIVE PER REQUEST
+DL_PARTS = 8      # MAX RANGED REQUESTS AT ONCE PER (BIG) DRIVE DOWNLOAD
+DL_PART_SECS = 2. # DOWNLOAD SECS (AT MEASURED SPEED) WORTH ANOTHER PART
+XFER_THREADS = 32 # THREADS SHARED BY ALL PARALLEL DOWNLOADS & UPLOADS
+COMPOSITE = None  # IMAGES OVER (BYTES) UPLOADED IN PARTS (set by --composite)
+COMPOSITE_MB = 150  # DEFAULT --composite THRESHOLD (MB)
+UL_PART = 32 << 20  # MIN BYTES PER PART OF COMPOSITE UPLOADS
+UL_PARTS = 32     # MAX PARTS PER COMPOSITE UPLOAD (GCS compose limit)
+UL_TMP = 'composite-parts/'  # GCS NAME PREFIX OF PARTS BEING UPLOADED
+UL_RETRIES = 2    # RETRIES OF PART UPLOADS & DELETES (5xx/429; idempotent)
+CRC_CHUNK = 1 << 20  # BYTES CHECKSUMMED AT A TIME
+SHEET_MAX_ROWS = 100000  # ROWS PER TAB BEFORE ROLLING OVER TO A NEW ONE
+SHEET_CELLS = 10000000   # MAX CELLS (ALL TABS) IN A SHEET, THEN NEW SHEET USED
+ROLLOVER = None   # SheetRoller FOR ROLLOVER/PER-FOLDER TABS (set by --rollover)
+NAMING = 'folder' # GCS OBJECT NAMES: 'folder', 'hash', 'date-hash' (see gcs_name)
+GCS_HASH = 4      # HEX DIGITS IN HASHED GCS OBJECT NAME PREFIXES
+BUCKETS = ()      # BUCKETS TO SPREAD IMAGES ACROSS (instead of just BUCKET)
+QUOTAS = {'drive': 12000, 'gcs': 0, 'vision': 1800, 'sheets': 60}  # CALLS/MIN (0: NO LIMIT)
+CALL_SECS = {'drive': .3, 'gcs': .3, 'vision': 1., 'sheets': .5}  # TYPICAL SECS PER CALL
+PLAN_MBPS = 20.   # TYPICAL MB/SEC PER TRANSFER (--plan estimates)
+INDEX_ROWS = 100000  # LABELS PER LABEL INDEX FILE
+LABELS = None     # LabelIndex FOR LABEL SEARCHES (set by --index)
+HTTP2_TIMEOUT = 300  # SECS TO WAIT FOR CONNECTS, READS & WRITES (--http2)
+HTTP2_BULK = 1 << 20  # BIGGER UPLOADS (BYTES), & DOWNLOADS, USE HTTP/1.1 (--http2)
 
 # process credentials for OAuth2 tokens
 SCOPES = (
@@ -44,119 +147,1931 @@ SCOPES = (
     'https://www.googleapis.com/auth/cloud-vision',
     'https://www.googleapis.com/auth/spreadsheets',
 )
-store = file.Storage('storage.json')
-creds = store.get()
-if not creds or creds.invalid:
-    flow = client.flow_from_clientsecrets('client_secret.json', SCOPES)
-    creds = tools.run_flow(flow, store)
+
+
+def authorize():
+    'return OAuth2 credentials, running auth flow (in browser) if none stored'
+    store = file.Storage('storage.json')
+    creds = store.get()
+    if not creds or creds.invalid:
+        flow = client.flow_from_clientsecrets('client_secret.json', SCOPES)
+        creds = tools.run_flow(flow, store)
+    return creds
 
 # create API service endpoints
-HTTP = creds.authorize(Http())
-DRIVE  = discovery.build('drive',   'v3', http=HTTP)
-GCS    = discovery.build('storage', 'v1', http=HTTP)
-VISION = discovery.build('vision',  'v1', http=HTTP)
-SHEETS = discovery.build('sheets',  'v4', http=HTTP)
+class ThreadLocalHttp(object):
+    'authorized Http for each thread (httplib2.Http is not thread-safe)'
+
+    def __init__(self, creds):
+        self._creds = creds
+        self._local = threading.local()
+
+    def __getattr__(self, name):
+        http = getattr(self._local, 'http', None)
+        if http is None:
+            http = self._local.http = self._creds.authorize(Http())
+        return getattr(http, name)
+
+
+class Http2(object):
+    'httplib2.Http stand-in: all threads share a few HTTP/2 connections'
+    # httpx is threadsafe & multiplexes concurrent calls as streams on 1
+    # connection per host (more only past ~100 streams), so 1 of these
+    # replaces an Http (connection, TLS handshake, fd) per thread. Image
+    # data still gets its own (kept open) HTTP/1.1 connections: streams
+    # share 1 connection's bandwidth, & httpx's flow control stalls with
+    # several big uploads at once
+
+    def __init__(self):
+        limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+        self.client = httpx.Client(http2=True, timeout=HTTP2_TIMEOUT, limits=limits)
+        self.bulk = httpx.Client(timeout=HTTP2_TIMEOUT, limits=limits)
+
+    def request(self, uri, method='GET', body=None, headers=None,
+            redirections=5, connection_type=None):
+        client = self.client
+        if 'alt=media' in uri or len(body or '') > HTTP2_BULK:
+            client = self.bulk
+        if isinstance(body, memoryview):    # zero-copy upload: stream slices
+            body = [body[i:i+DL_CHUNK] for i in range(0, len(body), DL_CHUNK)]
+        for retry in (True, False):
+            try:
+                rsp = client.request(method, uri, content=body,
+                        headers=headers, follow_redirects=redirections > 0)
+                break
+            except httpx.RemoteProtocolError as e:
+                if not retry:   # else reused connection closed: like httplib2
+                    raise socket.error(str(e))
+            except httpx.TimeoutException as e:  # retried like httplib2's errors
+                raise socket.timeout(str(e))
+            except httpx.TransportError as e:
+                raise socket.error(str(e))
+        # like httplib2: content decompressed, status & final URI in headers
+        info = dict(rsp.headers.items())
+        info.pop('content-encoding', None)
+        info['status'] = str(rsp.status_code)
+        info.setdefault('content-location', str(rsp.url))
+        return Response(info), rsp.content
+
+    def close(self):
+        self.client.close()
+        self.bulk.close()
+
+
+class CachedResource(object):
+    'API service (or resource) whose nested resources are built just once'
+    # googleapiclient rebuilds them, docs & all, on every call: for Sheets,
+    # MBs of docstrings per spreadsheets() call
+
+    def __init__(self, resource):
+        self._resource = resource
+        self._nested = {}
+        self._lock = threading.Lock()   # 1 thread builds each, not all at once
+
+    def __getattr__(self, name):
+        method = getattr(self._resource, name)
+        def call(*args, **kwargs):
+            if args or kwargs:      # API method, not a nested resource
+                return method(*args, **kwargs)
+            with self._lock:
+                if name not in self._nested:
+                    rsp = method()
+                    if not isinstance(rsp, discovery.Resource):
+                        return rsp
+                    self._nested[name] = CachedResource(rsp)
+                return self._nested[name]
+        return call
+
+
+class Recorder(object):
+    'Http wrapper recording API traffic to a (gzip-ed) cassette file'
+    # 1 JSON line per call; JSON replies kept whole, but other (image)
+    # data only by size: replays (see loadtest.py) stand in as many bytes
+
+    def __init__(self, http, path):
+        self.http = http
+        self.cassette = gzip.open(path, 'wb')
+        self.start = time.time()
+        self.lock = threading.Lock()
+
+    def request(self, uri, method='GET', body=None, headers=None, *args, **kwargs):
+        start = time.time()
+        rsp, content = self.http.request(uri, method, body, headers,
+                *args, **kwargs)
+        entry = {'t': round(start - self.start, 4),
+                'secs': round(time.time() - start, 4),
+                'method': method, 'uri': uri, 'status': rsp.status,
+                'headers': dict((k, rsp[k]) for k in ('content-type',
+                        'content-range') if k in rsp), 'size': len(content)}
+        if rsp.get('content-type', '').startswith('application/json'):
+            entry['body'] = content.decode('utf-8')
+        with self.lock:
+            self.cassette.write((json.dumps(entry) + '\n').encode('utf-8'))
+        return rsp, content
+
+    def close(self):
+        with self.lock:
+            self.cassette.close()
+
+
+def build_apis(http):
+    'return Drive, GCS, Vision, & Sheets API clients calling APIs via http'
+    return (CachedResource(discovery.build('drive',   'v3', http=http)),
+            CachedResource(discovery.build('storage', 'v1', http=http)),
+            CachedResource(discovery.build('vision',  'v1', http=http)),
+            CachedResource(discovery.build('sheets',  'v4', http=http)))
+
+
+# (built once authorized, by all but local-only "query" mode)
+HTTP = DRIVE = GCS = VISION = SHEETS = None
+
+
+class Hedger(object):
+    'if idempotent call is slower than usual (p95), resend it, use 1st reply'
+
+    def __init__(self, pct=HEDGE_PCT, workers=WORKERS):
+        self.pct = pct      # cap on hedged (extra) calls as % of all calls
+        self.calls = self.hedged = 0
+        self.latency = collections.defaultdict(
+                lambda: collections.deque(maxlen=HEDGE_SAMPLES))
+        self.lock = threading.Lock()
+        # a call & its hedge per worker, plus as many again for losing calls
+        # still running (a request already sent can't be stopped); only if
+        # more losers pile up do calls queue, & time queued for a thread
+        # counts toward the hedge delay (so may trigger needless hedges)
+        self.pool = futures.ThreadPoolExecutor(workers * 3)
+
+    def delay(self, api):
+        'return secs to wait before hedging call: p95 of recent latencies'
+        with self.lock:
+            samples = sorted(self.latency[api])
+        if len(samples) < 20:   # sized calls: not hedged until known (None)
+            return None if isinstance(api, tuple) else HEDGE_DELAY
+        return samples[int(len(samples) * .95)]
+
+    def timed(self, api, make_req):
+        'build & execute request, recording latency if successful'
+        start = time.time()
+        rsp = make_req().execute()
+        with self.lock:
+            self.latency[api].append(time.time() - start)
+        return rsp
+
+    def execute(self, api, make_req, size=None):
+        'execute request built by make_req(), hedging it if too slow'
+
+        # calls moving size bytes are only timed against (& hedged like)
+        # others moving about as many (within 2x); big ones aren't hedged,
+        # as a 2nd copy (maybe spilled to disk too) would cost the most
+        if size is not None:
+            if size >= BIG_IMG:
+                return make_req().execute()
+            api = api, size.bit_length()
+        with self.lock:
+            self.calls += 1
+        first = self.pool.submit(self.timed, api, make_req)
+        if futures.wait([first], self.delay(api)).done:
+            return first.result()
+        with self.lock:
+            hedge = self.hedged < self.calls * self.pct / 100.
+            if hedge:
+                self.hedged += 1
+        if not hedge:
+            return first.result()       # over budget: no hedging
+
+        # return 1st successful reply; a request already sent can't be
+        # stopped, so the slower one runs to completion and is ignored
+        pending = set([first, self.pool.submit(self.timed, api, make_req)])
+        while pending:
+            done, pending = futures.wait(pending,
+                    return_when=futures.FIRST_COMPLETED)
+            for call in done:
+                if not call.exception():
+                    for other in pending:
+                        other.cancel()
+                    return call.result()
+        return first.result()           # both failed: raise 1st error
+
+
+def execute(api, make_req, size=None):
+    'execute idempotent API request built by make_req(), hedged if enabled'
+    if HEDGER:
+        return HEDGER.execute(api, make_req, size)
+    return make_req().execute()
+
+
+class CircuitOpen(Exception):
+    'raised instead of calling an API whose circuit breaker is open'
+
+    def __init__(self, api, retry_in):
+        Exception.__init__(self, '%s API unavailable (circuit open), '
+                'retry in %.1f secs' % (api, retry_in))
+        self.retry_in = retry_in
+
+
+class CircuitBreaker(object):
+    'fail fast while an API is failing, probing now & then if it is back'
+
+    def __init__(self, api):
+        self.api = api
+        self.state = 'closed'   # 'open': failing fast; 'half-open': probing
+        self.opened = 0
+        self.reserved = 0       # when last image was let start toward a probe
+        self.failed = collections.deque(maxlen=BREAKER_CALLS*2)
+        self.lock = threading.Lock()
+
+    def check(self):
+        'raise CircuitOpen unless image needing API may start being processed'
+
+        # while open, 1 image per BREAKER_WAIT secs starts (its download,
+        # upload, etc.) to make the probe call, not every parked one
+        with self.lock:
+            if self.state == 'closed':
+                return
+            since = max(self.opened, self.reserved)
+            if self.state == 'half-open' or time.time() - since < BREAKER_WAIT:
+                raise CircuitOpen(self.api,
+                        max(since + BREAKER_WAIT - time.time(), 0))
+            self.reserved = time.time()
+
+    def call(self, fn, *args, **kwargs):
+        'call fn (using API) unless circuit is open, tracking its failures'
+
+        # after waiting BREAKER_WAIT secs, an open circuit lets 1 call through
+        with self.lock:
+            probe = self.state == 'open' and (
+                    time.time() - self.opened >= BREAKER_WAIT)
+            if self.state == 'half-open' or (self.state == 'open' and not probe):
+                raise CircuitOpen(self.api,
+                        max(self.opened + BREAKER_WAIT - time.time(), 0))
+            if probe:
+                self.state = 'half-open'
+        try:
+            rsp = fn(*args, **kwargs)
+        except Exception as e:
+            self.record(self.is_failure(e), probe)
+            raise
+        self.record(False, probe)
+        return rsp
+
+    @staticmethod
+    def is_failure(e):
+        'return True if error means API is in trouble (not a bad request)'
+        status = getattr(getattr(e, 'resp', None), 'status', 500)
+        return not isinstance(e, errors.HttpError) or status >= 500 or status == 429
+
+    def record(self, failed, probe):
+        'record call outcome, opening or closing circuit as needed'
+        with self.lock:
+            was = self.state
+            if probe:
+                self.state = 'open' if failed else 'closed'
+                self.opened = time.time()
+                self.failed.clear()
+            else:
+                self.failed.append(failed)
+                if self.state == 'closed' and len(self.failed) >= BREAKER_CALLS \
+                        and sum(self.failed) * 100. / len(self.failed) >= BREAKER_PCT:
+                    self.state, self.opened = 'open', time.time()
+            if (was == 'closed') != (self.state == 'closed'):
+                print('WARNING: %s API circuit %s' % (self.api, self.state))
+
+
+BREAKERS = {}   # API: CircuitBreaker
+
+
+def circuit_breaker(api):
+    'decorator: call function through circuit breaker for API it uses'
+    breaker = BREAKERS.setdefault(api, CircuitBreaker(api))
+    def wrap(fn):
+        @functools.wraps(fn)
+        def call(*args, **kwargs):
+            return breaker.call(fn, *args, **kwargs)
+        return call
+    return wrap
+
+
+class ImgBuffer(object):
+    'image data: in memory if small, else spilled to a temp file & mmap-ed'
+
+    def __init__(self, size):
+        if size > SPILL_SIZE:
+            # temp file is already unlinked; the mapping keeps its data
+            with tempfile.TemporaryFile(dir=SPILL_DIR) as f:
+                f.truncate(size)
+                buf = mmap.mmap(f.fileno(), size)
+        else:
+            buf = bytearray(size)
+        self.spilled = size > SPILL_SIZE
+        self.data = memoryview(buf)     # what every stage reads
+        self.pos = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def write(self, data):
+        'append downloaded data (as a file would)'
+        end = self.pos + len(data)
+        if end > len(self.data):
+            raise IOError('image bigger than its expected %d bytes' % len(self.data))
+        self.data[self.pos:end] = data
+        self.pos = end
+        return len(data)
+
+    def open(self):
+        'return (seekable) file object reading data without copying it all'
+        return ImgReader(self.data)
+
+
+class ImgReader(io.RawIOBase):
+    'read-only file object over a memoryview (io.BytesIO would copy it)'
+
+    def __init__(self, data):
+        self._data = data
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        chunk = self._data[self._pos:self._pos+len(b)]
+        b[:len(chunk)] = chunk
+        self._pos += len(chunk)
+        return len(chunk)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        start = (0, self._pos, len(self._data))[whence]
+        self._pos = max(0, start + offset)
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+
+TRANSFERS = []    # ThreadPoolExecutor FOR PARTS OF PARALLEL TRANSFERS (1st use)
+TRANSFERS_LOCK = threading.Lock()
+
+
+def transfers():
+    'return thread pool running parts of parallel downloads & uploads'
+    with TRANSFERS_LOCK:
+        if not TRANSFERS:
+            TRANSFERS.append(futures.ThreadPoolExecutor(XFER_THREADS))
+        return TRANSFERS[0]
+
+
+class DriveDownload(object):
+    'download of Drive file into an ImgBuffer, run (like a request) by execute()'
+    # 1 connection's bandwidth is often capped, so big files are fetched as
+    # DL_CHUNK ranges over several at once, each written in place: buffer
+    # is whole & in order when all are done
+    rate = PLAN_MBPS * (1<<20)  # BYTES/SEC PER CONNECTION (smoothed, measured)
+    lock = threading.Lock()
+
+    def __init__(self, file_id, size):
+        self.file_id = file_id
+        self.size = size
+
+    @classmethod
+    def parts(cls, size):
+        'return # of ranged requests to run at once: more if big or slow'
+        want = -(-size // int(cls.rate * DL_PART_SECS))
+        return max(1, min(DL_PARTS, -(-size // DL_CHUNK), want))
 
+    @classmethod
+    def measure(cls, nbytes, secs):
+        'fold throughput of a download request into per-connection rate'
+        if nbytes >= DL_CHUNK // 2 and secs > 0:    # too small to tell
+            with cls.lock:
+                cls.rate = .8 * cls.rate + .2 * nbytes / secs
 
+    def execute(self):
+        # fresh buffer each time, so hedged downloads don't share one
+        buf = ImgBuffer(self.size)
+        parts = self.parts(self.size)
+        if parts == 1:
+            dl = http.MediaIoBaseDownload(buf, DRIVE.files().get_media(
+                    fileId=self.file_id), chunksize=DL_CHUNK)
+            done = False
+            while not done:
+                start, pos = time.time(), buf.pos
+                done = dl.next_chunk()[1]
+                self.measure(buf.pos - pos, time.time() - start)
+        else:
+            ranges = collections.deque(range(0, self.size, DL_CHUNK))
+            ends = [self.size]  # where file ended, if shorter than listed
+            helpers = [transfers().submit(self.fetch, buf, ranges, ends)
+                    for _ in range(parts - 1)]
+            self.fetch(buf, ranges, ends)   # this thread helps too
+            for helper in helpers:
+                helper.result()     # raise 1st error, if any
+            buf.pos = min(ends)
+        if buf.pos != len(buf):     # file changed since listed; keep what came
+            buf.data = buf.data[:buf.pos]
+        return buf
+
+    def fetch(self, buf, ranges, ends):
+        'download ranges (shared w/other threads) into buf until none left'
+        try:
+            while True:
+                try:
+                    start = ranges.popleft()
+                except IndexError:
+                    return
+                end = min(start + DL_CHUNK, self.size) - 1
+                req = DRIVE.files().get_media(fileId=self.file_id)
+                began = time.time()
+                rsp, content = req.http.request(req.uri, headers=dict(
+                        req.headers, range='bytes=%d-%d' % (start, end)))
+                if rsp.status == 416:   # file shrank: nothing from start on
+                    ends.append(start)
+                    continue
+                if rsp.status not in (200, 206):
+                    raise errors.HttpError(rsp, content, uri=req.uri)
+                total = rsp.get('content-range', '').rpartition('/')[2]
+                if rsp.status == 200:   # range ignored: whole file came
+                    start, end, total = 0, self.size - 1, str(len(content))
+                    ranges.clear()
+                if total.isdigit() and int(total) > self.size:
+                    raise IOError('image bigger than its expected %d bytes' % self.size)
+                buf.data[start:start+len(content)] = content
+                if start + len(content) <= end:
+                    ends.append(start + len(content))
+                self.measure(len(content), time.time() - began)
+        except Exception:
+            ranges.clear()  # stop other threads: download failed
+            raise
+
+
+@circuit_breaker('drive')
 def drive_get_img(fname):
     'download file from Drive and return file info & binary if found'
 
-    # search for file on Google Drive
-    rsp = DRIVE.files().list(q="name='%s'" % fname,
-            fields='files(id,name,mimeType,modifiedTime)'
-    ).execute().get('files', [])
+    # search for file on Google Drive (unless given its already-listed info)
+    if isinstance(fname, dict):
+        rsp = [fname]
+    else:
+        rsp = execute('drive.list', lambda: DRIVE.files().list(q="name='%s'" %
+                fname, fields='files(id,name,mimeType,modifiedTime,size)'
+        )).get('files', [])
 
-    # download binary & return file info if found, else return None
+    # download binary (ImgBuffer) & return file info if found, else return None
     if rsp:
         target = rsp[0]  # use first matching file
         fileId = target['id']
         fname = target['name']
         mtype = target['mimeType']
-        binary = DRIVE.files().get_media(fileId=fileId).execute()
+        size = int(target.get('size', 0))
+        if size > VISION_MAX and not Image:
+            print('ERROR: %r too big for Vision API (shrinking it needs Pillow)'
+                    % fname)
+            return
+        binary = execute('drive.media', lambda: DriveDownload(fileId, size),
+                size)
         return fname, mtype, target['modifiedTime'], binary
 
 
+@circuit_breaker('drive')
+def drive_list_imgs(folder_id):
+    'return file info for all images in a Drive folder'
+
+    # page through folder listing, images only
+    files, token = [], None
+    while True:
+        rsp = execute('drive.list', lambda: DRIVE.files().list(q="'%s' in parents "
+                "and mimeType contains 'image/' and trashed=false" % folder_id,
+                fields='nextPageToken,'
+                        'files(id,name,mimeType,modifiedTime,size,md5Checksum)',
+                pageSize=1000, pageToken=token
+        ))
+        files.extend(rsp.get('files', []))
+        token = rsp.get('nextPageToken')
+        if not token:
+            return files
+
+
+class Scheduler(object):
+    'hand out images to workers by size, limiting big ones while small ones wait'
+    ORDERS = ('fifo', 'smallest', 'largest', 'mixed')
+
+    def __init__(self, targets, order=ORDER, workers=WORKERS):
+        # smallest 1st: 1st rows soonest; largest 1st: shortest total time
+        # (no big stragglers at end); mixed: alternate smallest & largest
+        # so small images' API calls overlap big ones' transfers
+        size = lambda target: int(target.get('size', 0))
+        if order != 'fifo':
+            targets = sorted(targets, key=size, reverse=order == 'largest')
+        if order == 'mixed':
+            targets = [targets[i//2] if i % 2 == 0 else targets[-1-i//2]
+                    for i in range(len(targets))]
+
+        # queue big & small images separately (but ranked in overall order)
+        # so small ones can start while all big image slots are in use
+        self.queues = {True: collections.deque(), False: collections.deque()}
+        for rank, target in enumerate(targets):
+            self.queues[size(target) >= BIG_IMG].append((rank, target))
+        self.big_slots = max(1, workers * BIG_PCT // 100)
+        self.lock = threading.Lock()
+
+    def next(self):
+        'return next image to start, or None once all have started'
+        # while small images wait, a big one starts (in its turn) only if a
+        # big slot is free, else the next small one does; once none are
+        # left, idle workers take big ones too (slots going negative), as
+        # holding them back would only leave workers idle
+        with self.lock:
+            small, big = self.queues[False], self.queues[True]
+            if big and (not small or (self.big_slots > 0 and
+                    big[0][0] < small[0][0])):
+                self.big_slots -= 1
+                return big.popleft()[1]
+            if small:
+                return small.popleft()[1]
+
+    def done(self, target):
+        'mark image finished, freeing its big slot if it was big'
+        if int(target.get('size', 0)) >= BIG_IMG:
+            with self.lock:
+                self.big_slots += 1
+
+
+def in_shard(file_id, shard):
+    'return True if Drive file ID belongs to shard (index, count)'
+
+    # stable across machines & runs (unlike hash(), which is salted)
+    index, count = shard
+    digest = hashlib.md5(file_id.encode('utf-8')).hexdigest()
+    return int(digest, 16) % count == index
+
+
+def queue_open(path):
+    'open (creating if needed) SQLite work queue of Drive images'
+
+    # autocommit mode; WAL lets workers read while another one writes;
+    # a worker's LeaseRenewer thread uses its connection too (never at once)
+    db = sqlite3.connect(path, timeout=60, isolation_level=None,
+            check_same_thread=False)
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('CREATE TABLE IF NOT EXISTS queue (id TEXT PRIMARY KEY, '
+            "info TEXT NOT NULL, state TEXT NOT NULL DEFAULT 'ready', "
+            'lease REAL NOT NULL DEFAULT 0, worker TEXT, '
+            'tries INTEGER NOT NULL DEFAULT 0)')
+    return db
+
+
+def queue_put(db, targets):
+    'add Drive file info to queue (skipping those already queued), return #added'
+    return db.executemany('INSERT OR IGNORE INTO queue (id, info) VALUES (?, ?)',
+            ((target['id'], json.dumps(target)) for target in targets)).rowcount
+
+
+def queue_lease(db, worker, lease):
+    'lease next ready image to worker for lease secs, return its file info'
+
+    # images whose lease expired (dead or stuck worker) are ready again,
+    # unless they have used up their tries; lock DB to lease atomically
+    now = time.time()
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        db.execute("UPDATE queue SET state='failed' WHERE state='leased' "
+                "AND lease < ? AND tries >= ?", (now, MAX_TRIES))
+        row = db.execute("SELECT id, info FROM queue WHERE state='ready' "
+                "OR (state='leased' AND lease < ?) LIMIT 1", (now,)).fetchone()
+        if row:
+            db.execute("UPDATE queue SET state='leased', lease=?, worker=?, "
+                    "tries=tries+1 WHERE id=?", (now + lease, worker, row[0]))
+        db.execute('COMMIT')
+    except Exception:
+        db.execute('ROLLBACK')
+        raise
+    if row:
+        return json.loads(row[1])
+
+
+class LeaseRenewer(object):
+    'renew lease on image being processed (every 3rd of it) until stopped'
+
+    def __init__(self, db, file_id, worker, lease):
+        self.db, self.file_id, self.worker = db, file_id, worker
+        self.lease = lease
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='LeaseRenewer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        # a slow image (big, or APIs backing off) isn't taken by others
+        # while this worker is alive; if it dies, its lease runs out
+        while not self.stopped.wait(self.lease / 3.):
+            try:
+                self.db.execute("UPDATE queue SET lease=? WHERE id=? AND "
+                        "worker=? AND state='leased'", (time.time() +
+                        self.lease, self.file_id, self.worker))
+            except sqlite3.Error as e:  # (DB busy) retried next time
+                print('WARNING: could not renew lease on %s: %s' % (
+                        self.file_id, e))
+
+    def stop(self):
+        'stop renewing lease (waiting for any renewal underway)'
+        self.stopped.set()
+        self.thread.join()
+
+
+def queue_wait(db):
+    'return secs until next lease held by another worker expires, else None'
+    rsp = db.execute("SELECT MIN(lease) FROM queue WHERE state='leased'").fetchone()
+    if rsp[0] is not None:
+        return max(rsp[0] - time.time(), 0)
+
+
+def queue_park(db, file_id, worker, wait):
+    'return leased image to queue in wait secs, without using up a try'
+    db.execute("UPDATE queue SET lease=?, worker=NULL, tries=tries-1 "
+            "WHERE id=? AND worker=?", (time.time() + wait, file_id, worker))
+
+
+def queue_done(db, file_id, worker, ok):
+    'release leased image: done if ok, else ready to retry (or failed)'
+    db.execute("UPDATE queue SET state=CASE WHEN ? THEN 'done' "
+            "WHEN tries >= ? THEN 'failed' ELSE 'ready' END, lease=0 "
+            "WHERE id=? AND worker=?", (ok, MAX_TRIES, file_id, worker))
+
+
+class MediaMemoryUpload(http.MediaUpload):
+    'simple (1-request) upload of in-memory data, sent as-is (no copies)'
+
+    def __init__(self, data, mimetype):
+        self._data = memoryview(data)
+        self._mimetype = mimetype
+
+    def chunksize(self):
+        return len(self._data)
+
+    def mimetype(self):
+        return self._mimetype
+
+    def size(self):
+        return len(self._data)
+
+    def resumable(self):
+        return False
+
+    def getbytes(self, begin, length):
+        return self._data[begin:begin+length]
+
+
+class Base64JsonBody(object):
+    'JSON request body whose binary data is base64-encoded as it is sent'
+    PLACEHOLDER = 'BASE64_DATA_PLACEHOLDER'     # stands in for data in body
+
+    def __init__(self, body, data):
+        self._head, self._tail = body.encode('utf-8').split(
+                ('"%s"' % self.PLACEHOLDER).encode('utf-8'))
+        self._head += b'"'
+        self._tail = b'"' + self._tail
+        self._data = memoryview(data)
+
+    def __len__(self):
+        return len(self._head) + (len(self._data)+2)//3*4 + len(self._tail)
+
+    def __iter__(self):
+        # restarts from the top each time, so resending (retries) also works
+        yield self._head
+        for i in range(0, len(self._data), B64_CHUNK):
+            yield base64.b64encode(self._data[i:i+B64_CHUNK])
+        yield self._tail
+
+
+@circuit_breaker('gcs')
 def gcs_blob_upload(fname, bucket, media, mimetype):
     'upload an object to a Google Cloud Storage bucket'
 
-    # build blob metadata and upload via GCS API
-    body = {'name': fname, 'uploadType': 'multipart', 'contentType': mimetype}
-    return GCS.objects().insert(bucket=bucket, body=body,
-            media_body=http.MediaIoBaseUpload(io.BytesIO(media), mimetype),
+    # big ones in parallel parts, if enabled
+    if composite_parts(len(media)) > 1:
+        return gcs_composite_upload(fname, bucket, media, mimetype)
+
+    # upload via GCS API; media-only upload avoids a multipart (copied) body
+    return GCS.objects().insert(bucket=bucket, name=fname,
+            media_body=MediaMemoryUpload(media, mimetype),
             fields='bucket,name').execute()
 
 
-def vision_label_img(img, top):
-    'send image to Vision API for label annotation'
+def composite_parts(size):
+    'return # of parts to upload object of size in (1: not a composite)'
+    if COMPOSITE is None or size <= COMPOSITE:
+        return 1
+    return max(1, min(UL_PARTS, size // UL_PART))
+
+
+def crc32c(data):
+    'return CRC32C of data (google_crc32c takes only read-only data: copied)'
+    crc = 0
+    for i in range(0, len(data), CRC_CHUNK):
+        crc = google_crc32c.extend(crc, bytes(data[i:i+CRC_CHUNK]))
+    return crc
+
+
+def crc32c_combine(crc1, crc2, len2):
+    'return CRC32C of A+B from CRC32Cs of A & B (len2 bytes long), like zlib'
+    # appending len2 zero bytes to A is a linear map (a 32x32 GF(2) matrix)
+    # on its CRC; squaring matrices builds it in log2(len2) steps
+    def times(mat, vec):
+        total, i = 0, 0
+        while vec:
+            if vec & 1:
+                total ^= mat[i]
+            vec >>= 1
+            i += 1
+        return total
+    def square(mat):
+        return [times(mat, row) for row in mat]
+    if not len2:
+        return crc1
+    odd = [0x82F63B78] + [1 << n for n in range(31)]    # 1 zero bit
+    even = square(odd)      # 2 zero bits
+    odd = square(even)      # 4 zero bits
+    while len2:             # 1st pass: 1 zero byte
+        even = square(odd)
+        if len2 & 1:
+            crc1 = times(even, crc1)
+        len2 >>= 1
+        if not len2:
+            break
+        odd = square(even)
+        if len2 & 1:
+            crc1 = times(odd, crc1)
+        len2 >>= 1
+    return crc1 ^ crc2
+
+
+def gcs_crc32c(rsp, what):
+    'return CRC32C GCS computed for an object it stored'
+    if 'crc32c' not in rsp:
+        raise IOError('no CRC32C to check %s against' % what)
+    return struct.unpack('>I', base64.b64decode(rsp['crc32c']))[0]
+
+
+def gcs_composite_upload(fname, bucket, media, mimetype):
+    'upload big object as parts in parallel, then compose them (CRC32C-checked)'
+
+    # upload parts as temp objects (this & helper threads), checking each
+    # arrived intact: by CRC32C (MD5 if no google_crc32c), so GCS's CRC32Cs
+    # of the parts, combined, are what the composed object's must be
+    media = memoryview(media)
+    count = composite_parts(len(media))
+    size = -(-len(media) // count)
+    prefix = '%s%s/' % (UL_TMP, uuid.uuid4().hex)
+    names = ['%s%02d' % (prefix, i) for i in range(count)]
+    def upload(i):
+        part = media[i*size:(i+1)*size]
+        rsp = GCS.objects().insert(bucket=bucket, name=names[i],
+                media_body=MediaMemoryUpload(part, mimetype),
+                fields='crc32c,md5Hash').execute(num_retries=UL_RETRIES)
+        crc = gcs_crc32c(rsp, 'part %d of %r' % (i, fname))
+        if google_crc32c:
+            ok = crc == crc32c(part)
+        else:
+            ok = rsp.get('md5Hash') == base64.b64encode(
+                    hashlib.md5(part).digest()).decode('ascii')
+        if not ok:
+            raise IOError('part %d of %r corrupted in upload' % (i, fname))
+        return crc, len(part)
+    helpers = [transfers().submit(upload, i) for i in range(1, count)]
+    try:
+        parts = [upload(0)] + [helper.result() for helper in helpers]
+        rsp = GCS.objects().compose(destinationBucket=bucket,
+                destinationObject=fname, body={
+                    'sourceObjects': [{'name': name} for name in names],
+                    'destination': {'contentType': mimetype},
+                }, fields='bucket,name,crc32c').execute()
+        crc = parts[0][0]
+        for part_crc, length in parts[1:]:
+            crc = crc32c_combine(crc, part_crc, length)
+        if gcs_crc32c(rsp, repr(fname)) != crc:
+            GCS.objects().delete(bucket=bucket, object=fname).execute()
+            raise IOError('%r corrupted composing its parts' % fname)
+        return {'bucket': rsp['bucket'], 'name': rsp['name']}
+    finally:
+        # delete parts (once all are done), whether composed or not
+        for helper in helpers:
+            helper.cancel()
+        futures.wait(helpers)
+        futures.wait([transfers().submit(gcs_delete_part, bucket, name)
+                for name in names])
+
+
+def gcs_delete_part(bucket, name):
+    'delete temp object (part of composite upload), if it is there'
+    try:
+        GCS.objects().delete(bucket=bucket, object=name).execute(
+                num_retries=UL_RETRIES)
+    except errors.HttpError:
+        pass    # never uploaded (or already gone); else, left for lifecycle rule
+
+
+def gcs_name(bucket, folder, fname, ftime):
+    'return (bucket, object name) to archive image in, per NAMING & BUCKETS'
+
+    # names (& buckets) depend only on image, so reruns overwrite, not copy;
+    # hashed prefixes spread writes across GCS key ranges (& its servers)
+    path = '%s/%s' % (folder, fname)
+    digest = hashlib.md5(path.encode('utf-8')).hexdigest()
+    if BUCKETS:
+        bucket = BUCKETS[int(digest, 16) % len(BUCKETS)]
+    if NAMING == 'hash':
+        path = '%s/%s' % (digest[:GCS_HASH], path.lstrip('/'))
+    elif NAMING == 'date-hash':     # date image last modified
+        path = '%s/%s/%s' % (ftime[:10], digest[:GCS_HASH], path.lstrip('/'))
+    return bucket, path
+
+
+def gcs_link(bucket, name, text):
+    'return Sheet HYPERLINK formula for GCS object'
+    return '=HYPERLINK("storage.cloud.google.com/%s/%s", "%s")' % (
+            bucket, quote(name.encode('utf-8')), text.replace('"', '""'))
+
+
+def gcs_split(uri):
+    'split "gs://bucket/prefix" into bucket & prefix'
+    if not uri.startswith('gs://'):
+        raise ValueError('not a gs:// URI: %r' % uri)
+    bucket, _, prefix = uri[5:].partition('/')
+    return bucket, prefix
+
+
+def gcs_list_objs(bucket, prefix, images=True):
+    'return object info for all (image) objects in GCS bucket with prefix'
+
+    # page through bucket listing
+    objs, token = [], None
+    while True:
+        rsp = GCS.objects().list(bucket=bucket, prefix=prefix, pageToken=token,
+                fields='nextPageToken,items(bucket,name,contentType,updated,size)'
+        ).execute()
+        objs.extend(obj for obj in rsp.get('items', []) if not images or
+                obj.get('contentType', '').startswith('image/'))
+        token = rsp.get('nextPageToken')
+        if not token:
+            return objs
 
-    # build image metadata and call Vision API to process
+
+def vision_labels(rsp, top):
+    'return top labels as CSV for Sheet (cell)'
+    return ', '.join('(%.2f%%) %s' % (
+            label['score']*100., label['description']) \
+            for label in rsp.get('labelAnnotations', [])[:top])
+
+
+def vision_text(rsp, top):
+    'return all text found (OCR) for Sheet (cell), truncated to cell limit'
+    text = rsp.get('textAnnotations', [{}])[0].get('description', '')
+    return text.strip()[:50000]
+
+
+def vision_safe_search(rsp, top):
+    'return safe-search likelihoods as CSV for Sheet (cell)'
+    safe = rsp.get('safeSearchAnnotation', {})
+    return ', '.join('%s: %s' % (key, safe[key]) for key in (
+            'adult', 'spoof', 'medical', 'violence', 'racy') if key in safe)
+
+
+def vision_colors(rsp, top):
+    'return top dominant colors (by pixel fraction) as CSV for Sheet (cell)'
+    colors = rsp.get('imagePropertiesAnnotation', {}).get(
+            'dominantColors', {}).get('colors', [])
+    colors = sorted(colors, key=lambda c: c.get('pixelFraction', 0), reverse=True)
+    return ', '.join('(%.2f%%) #%02x%02x%02x' % (
+            color.get('pixelFraction', 0)*100., color['color'].get('red', 0),
+            color['color'].get('green', 0), color['color'].get('blue', 0)) \
+            for color in colors[:top])
+
+
+# CLI feature name: (Vision API feature type, fn: response -> Sheet cell)
+VISION_FEATURES = {
+    'labels':     ('LABEL_DETECTION',       vision_labels),
+    'text':       ('TEXT_DETECTION',        vision_text),
+    'safesearch': ('SAFE_SEARCH_DETECTION', vision_safe_search),
+    'colors':     ('IMAGE_PROPERTIES',      vision_colors),
+}
+
+
+def img_dhash(img_buf):
+    'return 64-bit difference hash (dHash) of image, None if unreadable'
+
+    # shrink to 9x8 grayscale, then 1 bit per pixel: brighter than its
+    # left neighbor? (same for resized, recompressed, etc., copies)
+    try:
+        img = Image.open(img_buf.open())
+        img.draft('L', (36, 32))    # JPEG: decode at reduced size, much faster
+        pixels = numpy.asarray(img.convert('L').resize((9, 8), Image.LANCZOS),
+                dtype=numpy.int16)
+    except Exception:   # unreadable, unsupported, too many pixels, etc.
+        return
+    bits = pixels[:, 1:] > pixels[:, :-1]
+    return int(numpy.packbits(bits).view('>u8')[0])
+
+
+class BKTree(object):
+    'BK-tree of 64-bit image hashes, finding those within a Hamming distance'
+
+    def __init__(self):
+        self.root = None    # [hash, value, {distance: child node}]
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def distance(a, b):
+        return bin(a ^ b).count('1')
+
+    def add(self, key, value):
+        'add hash (key) & value, unless hash already there'
+        with self.lock:
+            if self.root is None:
+                self.root = [key, value, {}]
+                return
+            node = self.root
+            while True:
+                dist = self.distance(key, node[0])
+                if not dist:
+                    return
+                if dist not in node[2]:
+                    node[2][dist] = [key, value, {}]
+                    return
+                node = node[2][dist]
+
+    def find(self, key, max_dist):
+        'return (value, distance) of closest hash within max_dist, else None'
+        best = None
+        with self.lock:
+            nodes = [self.root] if self.root else []
+            while nodes:
+                node = nodes.pop()
+                dist = self.distance(key, node[0])
+                if dist <= max_dist and (not best or dist < best[1]):
+                    best = node[1], dist
+                # triangle inequality: only these subtrees can be close enough
+                nodes.extend(child for d, child in node[2].items()
+                        if dist - max_dist <= d <= dist + max_dist)
+        return best
+
+
+@circuit_breaker('vision')
+def vision_shrink(img_buf):
+    'return image data Vision API takes: as is, or a smaller JPEG (None if not)'
+
+    # base64-ed, images over VISION_MAX bytes would exceed Vision's request
+    # size limit: decode (JPEG: at reduced size) and re-encode smaller
+    if len(img_buf) <= VISION_MAX:
+        return img_buf.data
+    try:
+        img = Image.open(img_buf.open())
+        img.draft('RGB', (VISION_PX, VISION_PX))
+        img.thumbnail((VISION_PX, VISION_PX), Image.LANCZOS)
+        out = io.BytesIO()
+        img.convert('RGB').save(out, 'JPEG', quality=90)
+    except Exception:   # unreadable, unsupported, too many pixels, etc.
+        return
+    if out.tell() <= VISION_MAX:
+        return out.getvalue()
+
+
+def vision_annotate_img(img, top, features=FEATURES):
+    'send image to Vision API for all features at once, return Sheet cells'
+
+    # build image metadata and call Vision API to process; image binary
+    # is base64-encoded into the request as it is sent, not beforehand
     body = {'requests': [{
-                'image':     {'content': img},
-                'features': [{'type': 'LABEL_DETECTION', 'maxResults': top}],
+                'image':     {'content': Base64JsonBody.PLACEHOLDER},
+                'features': [{'type': VISION_FEATURES[feature][0],
+                        'maxResults': top} for feature in features],
     }]}
-    rsp = VISION.images().annotate(body=body).execute().get('responses', [{}])[0]
+    def annotate():
+        req = VISION.images().annotate(body=body)
+        req.body = Base64JsonBody(req.body, img)
+        req.body_size = len(req.body)
+        req.headers['content-length'] = str(req.body_size)
+        return req
+    rsp = execute('vision', annotate, len(img)).get('responses', [{}])[0]
+
+    # return one cell per feature for Sheet (row) if any results found
+    cells = [VISION_FEATURES[feature][1](rsp, top) for feature in features]
+    if any(cells):
+        return cells
+
+
+def vision_batch_submit(uris, top, features, out_uri):
+    'start Vision asyncBatchAnnotate operation on GCS images, return its name'
+
+    # results go to JSON files of BATCH_OUT responses each under out_uri
+    body = {'requests': [{
+                'image':     {'source': {'imageUri': uri}},
+                'features': [{'type': VISION_FEATURES[feature][0],
+                        'maxResults': top} for feature in features],
+            } for uri in uris],
+            'outputConfig': {'gcsDestination': {'uri': out_uri},
+                    'batchSize': BATCH_OUT},
+    }
+    return VISION.images().asyncBatchAnnotate(body=body).execute()['name']
+
+
+def vision_batch_status(name):
+    'get Vision batch operation (by name as asyncBatchAnnotate returned it)'
+
+    # "operations.get" only takes "operations/ID" names; project ones (with or
+    # without location) go to the matching "projects" resource's method
+    if name.startswith('projects/'):
+        ops = VISION.projects().locations().operations() if (
+                '/locations/' in name) else VISION.projects().operations()
+    else:
+        ops = VISION.operations()
+    return ops.get(name=name).execute()
 
-    # return top labels for image as CSV for Sheet (row)
-    if 'labelAnnotations' in rsp:
-        return ', '.join('(%.2f%%) %s' % (
-                label['score']*100., label['description']) \
-                for label in rsp['labelAnnotations'])
+
+def vision_batch_results(out_uri):
+    'yield responses from Vision batch output files, in request order'
+
+    # read one output file at a time ("output-1-to-100.json", ...)
+    def first(obj):
+        match = re.search(r'output-(\d+)-to-', obj['name'])
+        return int(match.group(1)) if match else 0
+    bucket, prefix = gcs_split(out_uri)
+    for obj in sorted(gcs_list_objs(bucket, prefix, images=False), key=first):
+        rsp = json.loads(GCS.objects().get_media(bucket=bucket,
+                object=obj['name']).execute().decode('utf-8'))
+        for rsp in rsp.get('responses', []):
+            yield rsp
 
 
 def sheet_append_row(sheet, row):
     'append row to a Google Sheet, return #cells added'
+    return sheet_add_rows(sheet, [row])
+
+
+def sheet_add_rows(sheet, rows):
+    'append rows to a Google Sheet (or its rollover tabs), return #cells added'
+    if ROLLOVER:
+        return ROLLOVER.append(sheet, rows)
+    return sheet_append_rows(sheet, rows)
+
 
-    # call Sheets API to write row to Sheet (via its ID)
+def sheet_range(tab):
+    'return A1-notation range for (quoted) tab name'
+    return "'%s'" % tab.replace("'", "''")
+
+
+@circuit_breaker('sheets')
+def sheet_append_rows(sheet, rows, tab='Sheet1'):
+    'append rows to a Google Sheet, return #cells added'
+
+    # call Sheets API to write rows to Sheet (via its ID)
     rsp = SHEETS.spreadsheets().values().append(
-            spreadsheetId=sheet, range='Sheet1',
-            valueInputOption='USER_ENTERED', body={'values': [row]}
+            spreadsheetId=sheet, range=sheet_range(tab),
+            valueInputOption='USER_ENTERED', body={'values': rows}
     ).execute()
     if rsp:
         return rsp.get('updates').get('updatedCells')
 
 
-def main(fname, bucket, sheet_id, folder, top, debug):
+@circuit_breaker('sheets')
+def sheets_execute(req):
+    'execute (other) Sheets API request'
+    return req.execute()
+
+
+class SheetRoller(object):
+    'append rows to Sheet tabs, rolling over to new tabs (& Sheets) when full'
+    INDEX = 'Index'     # tab (in original Sheet) recording where rows went
+    INDEX_HEADER = ['Folder (* = all)', 'Sheet ID', 'Tab', 'Link', 'Since']
+
+    def __init__(self, max_rows=SHEET_MAX_ROWS, by_folder=False):
+        self.max_rows = max_rows
+        self.by_folder = by_folder
+        self.where = {}     # (Sheet ID, folder or '*'): [Sheet ID, tab, #rows]
+        self.latest = {}    # Sheet ID: newest Sheet for its rows (once indexed)
+        self.lock = threading.Lock()
+
+    def append(self, sheet_id, rows):
+        'append rows to current tab for (each of) their folders, return #cells'
+        groups = collections.OrderedDict()
+        for row in rows:
+            groups.setdefault(row[0] if self.by_folder else '*', []).append(row)
+        cells = 0
+        with self.lock:
+            if sheet_id not in self.latest:
+                self._read_index(sheet_id)
+            for key, rows in groups.items():
+                where = self.where.get((sheet_id, key))
+                if where and where[2] is None:
+                    where[2] = self._count_rows(where[0], where[1])
+                while rows:     # (split so no tab outgrows max_rows)
+                    while not where or where[2] >= self.max_rows:
+                        where = self._roll(sheet_id, key, where, len(rows[0]))
+                    room = self.max_rows - where[2]
+                    cells += sheet_append_rows(where[0], rows[:room],
+                            where[1]) or 0
+                    where[2] += len(rows[:room])
+                    rows = rows[room:]
+        return cells
+
+    def _read_index(self, sheet_id):
+        # where rows go is kept in the Index tab, so later runs continue there
+        latest = sheet_id
+        if self.INDEX not in self._tabs(sheet_id):
+            self._add_tab(sheet_id, self.INDEX, len(self.INDEX_HEADER))
+            self._index(sheet_id, self.INDEX_HEADER)
+        else:
+            rsp = sheets_execute(SHEETS.spreadsheets().values().get(
+                    spreadsheetId=sheet_id, range=sheet_range(self.INDEX) + '!A2:C'))
+            for row in rsp.get('values', []):
+                if len(row) == 3:
+                    key, latest, tab = row
+                    self.where[(sheet_id, key)] = [latest, tab, None]
+        self.latest[sheet_id] = latest
+
+    def _roll(self, sheet_id, key, where, width):
+        # start folder in its own tab, else roll over to next free tab name,
+        # in a new Sheet once the newest one has no room for another full tab
+        base = 'Sheet1' if key in ('*', '') else key[:90]
+        rows = 0
+        for sheet in (where[0] if where else sheet_id, self.latest[sheet_id]):
+            tabs = self._tabs(sheet)
+            if where is None and base in tabs:
+                tab = base      # e.g., original Sheet1: count rows already there
+                rows = self._count_rows(sheet, tab)
+                break
+            if self._cells(tabs) + self.max_rows*width <= SHEET_CELLS:
+                tab = self._free_tab(base, tabs)
+                self._add_tab(sheet, tab, width)
+                break
+        else:
+            title = sheets_execute(SHEETS.spreadsheets().get(spreadsheetId=sheet_id,
+                    fields='properties.title'))['properties']['title']
+            tab = base
+            sheet = sheets_execute(SHEETS.spreadsheets().create(body={
+                    'properties': {'title': '%s (%s)' % (
+                            title, time.strftime('%Y-%m-%d %H:%M'))},
+                    'sheets': [{'properties': self._tab_props(tab, width)}],
+            }, fields='spreadsheetId'))['spreadsheetId']
+            self.latest[sheet_id] = sheet
+            print('Rows for %r now go to new Sheet %s' % (key, sheet))
+        self.where[(sheet_id, key)] = where = [sheet, tab, rows]
+        self._index(sheet_id, [key, sheet, tab,
+                'https://docs.google.com/spreadsheets/d/%s' % sheet,
+                time.strftime('%Y-%m-%d %H:%M:%S')])
+        return where
+
+    @staticmethod
+    def _free_tab(base, tabs):
+        if base not in tabs:
+            return base
+        n = 2
+        while '%s (%d)' % (base, n) in tabs:
+            n += 1
+        return '%s (%d)' % (base, n)
+
+    def _cells(self, tabs):
+        # cells Sheet's tabs may grow to: each (but Index) up to max_rows,
+        # so room is kept for tabs not yet full (appends fail past SHEET_CELLS)
+        return sum((rows if tab == self.INDEX else max(rows, self.max_rows))
+                * cols for tab, (rows, cols) in tabs.items())
+
+    @staticmethod
+    def _tab_props(tab, width):
+        # grid as small as possible: empty cells count toward Sheet's limit
+        return {'title': tab, 'gridProperties': {'rowCount': 1, 'columnCount': width}}
+
+    def _tabs(self, sheet):
+        rsp = sheets_execute(SHEETS.spreadsheets().get(spreadsheetId=sheet,
+                fields='sheets.properties(title,gridProperties)'))
+        return dict((tab['properties']['title'],
+                (tab['properties']['gridProperties']['rowCount'],
+                tab['properties']['gridProperties']['columnCount']))
+                for tab in rsp.get('sheets', []))
+
+    def _add_tab(self, sheet, tab, width):
+        sheets_execute(SHEETS.spreadsheets().batchUpdate(spreadsheetId=sheet,
+                body={'requests': [{'addSheet': {'properties':
+                self._tab_props(tab, width)}}]}))
+
+    def _count_rows(self, sheet, tab):
+        # column B (image link) is never empty, unlike A (folder)
+        rsp = sheets_execute(SHEETS.spreadsheets().values().get(
+                spreadsheetId=sheet, range=sheet_range(tab) + '!B:B',
+                majorDimension='COLUMNS'))
+        return len(rsp.get('values', [[]])[0])
+
+    def _index(self, sheet_id, row):
+        # RAW: keep folder names like "0042" as-is
+        sheets_execute(SHEETS.spreadsheets().values().append(
+                spreadsheetId=sheet_id, range=sheet_range(self.INDEX),
+                valueInputOption='RAW', body={'values': [row]}))
+
+
+class RowBuffer(object):
+    'buffer Sheet rows for bulk appends, logging them to disk until appended'
+
+    def __init__(self, path, debug=False):
+        self.path = path
+        self.debug = debug
+        self.rows = []      # (Sheet ID, row) in order added
+        self.unsynced = 0
+        self.lock = threading.Lock()
+
+        # replay rows logged but not appended to Sheet before a crash; the
+        # last line may be partly written, & rows appended just before a
+        # crash (but not yet cleared from log) are added again
+        if os.path.exists(path):
+            with open(path) as log:
+                for line in log:
+                    try:
+                        self.rows.append(tuple(json.loads(line)))
+                    except ValueError:
+                        break
+        self.log = open(path, 'a')
+        if self.rows:
+            print('Replaying %d pending row(s) from %r' % (len(self.rows), path))
+            try:
+                self.flush()
+            except Exception as e:  # still logged: retried later
+                print('WARNING: could not append rows to Sheet: %s' % e)
+
+        # don't leave rows waiting too long for more when things are slow
+        thread = threading.Thread(target=self._run, name='RowBuffer')
+        thread.daemon = True
+        thread.start()
+
+    def add(self, sheet_id, row):
+        'log & buffer row, appending buffered rows once there are enough'
+        with self.lock:
+            # written out (survives process being killed) right away, but
+            # only fsync-ed (survives OS crash/power loss) every WAL_SYNC rows
+            self.log.write(json.dumps([sheet_id, row]) + '\n')
+            self.log.flush()
+            self.rows.append((sheet_id, row))
+            self.unsynced += 1
+            if self.unsynced >= WAL_SYNC:
+                self._sync()
+            if len(self.rows) >= SHEET_ROWS:
+                try:
+                    self._flush()
+                except Exception as e:  # row is logged: retried later
+                    print('WARNING: could not append rows to Sheet: %s' % e)
+
+    def _sync(self):
+        self.log.flush()
+        os.fsync(self.log.fileno())
+        self.unsynced = 0
+
+    def _flush(self):
+        # all rows must be safely logged before trying to append them;
+        # if appending fails, they stay logged & buffered for next time
+        self._sync()
+        sheets = collections.OrderedDict()
+        for sheet_id, row in self.rows:
+            sheets.setdefault(sheet_id, []).append(row)
+        while sheets:
+            sheet_id, rows = next(iter(sheets.items()))
+            rsp = sheet_add_rows(sheet_id, rows)
+            if self.debug:
+                print('Added %d cells (%d rows) to Google Sheet' % (
+                        rsp or 0, len(rows)))
+            del sheets[sheet_id]
+            self.rows = [(s, row) for s, row in self.rows if s != sheet_id]
+            self._rewrite()
+
+    def _rewrite(self):
+        # truncate log once all rows appended, else atomically replace it
+        # with one holding only rows still pending (for other Sheets)
+        if not self.rows:
+            self.log.truncate(0)
+            self._sync()
+            return
+        tmp = '%s.%d' % (self.path, os.getpid())
+        with open(tmp, 'w') as log:
+            for pending in self.rows:
+                log.write(json.dumps(pending) + '\n')
+            log.flush()
+            os.fsync(log.fileno())
+        self.log.close()
+        os.replace(tmp, self.path)
+        self.log = open(self.path, 'a')
+
+    def flush(self):
+        'append all buffered rows to Sheet(s) now'
+        with self.lock:
+            if self.rows:
+                self._flush()
+
+    def _run(self):
+        while True:
+            time.sleep(WAL_AGE)
+            try:
+                self.flush()
+            except Exception as e:  # retried on next add() or flush()
+                print('WARNING: could not append rows to Sheet: %s' % e)
+
+    def close(self):
+        'append all buffered rows, then close log'
+        try:
+            self.flush()
+        except Exception as e:  # appended on next run (replayed from log)
+            print('WARNING: could not append rows to Sheet (kept in %r): %s'
+                    % (self.path, e))
+        self.log.close()
+
+
+LABEL_RE = re.compile(r'\((\d+(?:\.\d+)?)%\) (.+?)(?=, \(\d|$)')  # in Sheet cell
+
+
+class LabelIndex(object):
+    'label search index: Arrow files of (label, score, image) rows'
+    # each file is sorted by label, then score (best first); a JSON
+    # (inverted) index says where each label's rows are, so searches
+    # read just those rows, straight from memory-mapped files
+    COLUMNS = ('label', 'score', 'image', 'name', 'folder', 'modified')
+
+    def __init__(self, path):
+        self.path = path
+        self.rows = []      # (label key, *COLUMNS)
+        self.lock = threading.Lock()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def add(self, cell, image, name, folder, modified):
+        'add labels (from Sheet cell) of image, writing a file once enough'
+        with self.lock:
+            for score, label in LABEL_RE.findall(cell):
+                self.rows.append((label.lower(), label, float(score) / 100,
+                        image, name, folder, modified))
+            if len(self.rows) >= INDEX_ROWS:
+                self._write()
+
+    def _write(self):
+        rows = sorted(self.rows, key=lambda row: (row[0], -row[2]))
+        self.rows = []
+        where = collections.OrderedDict()   # label key: [1st row, #rows]
+        for i, row in enumerate(rows):
+            where.setdefault(row[0], [i, 0])[1] += 1
+        columns = list(zip(*rows))[1:]
+        table = pyarrow.Table.from_arrays([pyarrow.array(columns[0]).dictionary_encode(),
+                pyarrow.array(columns[1], pyarrow.float32())] +
+                [pyarrow.array(column) for column in columns[2:]], self.COLUMNS)
+
+        # JSON index 1st: a file only counts once its .arrow file is there
+        part = os.path.join(self.path, 'labels-%s' % uuid.uuid4().hex)
+        with open(part + '.json', 'w') as index:
+            json.dump(where, index)
+        with pyarrow.OSFile(part + '.tmp', 'wb') as sink:
+            with pyarrow.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(part + '.tmp', part + '.arrow')
+
+    def flush(self):
+        'write all labels added so far'
+        with self.lock:
+            if self.rows:
+                self._write()
+
+    close = flush
+
+    def parts(self):
+        'return [(Arrow table, {label key: [1st row, #rows]})], 1 per file'
+        parts = []
+        for name in sorted(glob.glob(os.path.join(self.path, 'labels-*.arrow'))):
+            with open(name[:-len('.arrow')] + '.json') as index:
+                where = json.load(index)
+            parts.append((pyarrow.ipc.open_file(
+                    pyarrow.memory_map(name)).read_all(), where))
+        return parts
+
+    def search(self, labels, min_score=0., folder=None, limit=None):
+        'return (dict) rows of images with all labels over min_score, best 1st'
+        parts, found = self.parts(), None
+        for label in labels:
+            hits = {}   # image: best-scoring row for this label
+            for table, where in parts:
+                if label.lower() not in where:
+                    continue
+                rows = table.slice(*where[label.lower()])
+                count = pyarrow.compute.sum(pyarrow.compute.greater(
+                        rows['score'], min_score)).as_py() or 0
+                for row in rows.slice(0, count).to_pylist():   # best 1st
+                    if folder is not None and row['folder'] != folder:
+                        continue
+                    if row['score'] > hits.get(row['image'], {}).get('score', -1):
+                        hits[row['image']] = row
+            if found is not None:   # images with every label: worst score
+                hits = dict((image, min(row, found[image], key=lambda r: r['score']))
+                        for image, row in hits.items() if image in found)
+            found = hits
+        rows = sorted((found or {}).values(), key=lambda row: -row['score'])
+        return rows[:limit] if limit else rows
+
+    def compact(self):
+        'merge all index files into 1 (searches open 1 file, not many)'
+        with self.lock:
+            names = glob.glob(os.path.join(self.path, 'labels-*.arrow'))
+            for table, where in self.parts():
+                label = [str(l) for l in table['label'].to_pylist()]
+                self.rows.extend(zip([l.lower() for l in label], label,
+                        *[table[column].to_pylist() for column in self.COLUMNS[1:]]))
+            if self.rows:
+                self._write()
+            for name in names:
+                os.remove(name)
+                os.remove(name[:-len('.arrow')] + '.json')
+            return len(names)
+
+
+def main_query(path, labels, min_score=0., folder=None, limit=None):
+    '"main_query()" searches label index for images with all labels'
+    start = time.time()
+    rows = LabelIndex(path).search(labels, min_score, folder, limit)
+    for row in rows:
+        print('(%.2f%%) %s: storage.cloud.google.com/%s' % (
+                row['score'] * 100, row['name'], quote(row['image'].encode('utf-8'))))
+    print('Found %d image(s) in %.1f ms' % (len(rows), (time.time() - start) * 1000))
+    return rows
+
+
+def main(fname, bucket, sheet_id, folder, top, debug, features=FEATURES):
     '"main()" drives process from image download through report generation'
 
+    # park image up front if an API it needs is failing (circuit open)
+    for api in ('drive', 'gcs', 'vision') + (() if ROWS else ('sheets',)):
+        BREAKERS[api].check()
+
     # download img file & info from Drive
     rsp = drive_get_img(fname)
     if not rsp:
         return
-    fname, mtype, ftime, data = rsp
+    fname, mtype, ftime, img_buf = rsp
+    data = img_buf.data
     if debug:
-        print('Downloaded %r (%s, %s, size: %d)' % (fname, mtype, ftime, len(data)))
+        print('Downloaded %r (%s, %s, size: %d%s)' % (fname, mtype, ftime,
+                len(data), ', spilled to disk' if img_buf.spilled else ''))
 
     # upload file to GCS
-    gcsname = '%s/%s'% (folder, fname)
+    bucket, gcsname = gcs_name(bucket, folder, fname, ftime)
     rsp = gcs_blob_upload(gcsname, bucket, data, mtype)
     if not rsp:
         return
     if debug:
         print('Uploaded %r to GCS bucket %r' % (rsp['name'], rsp['bucket']))
 
-    # process w/Vision
-    rsp = vision_label_img(base64.b64encode(data).decode('utf-8'), top)
-    if not rsp:
-        return
+    # process w/Vision, unless a near-duplicate image was already processed
+    dupe, dhash = None, PHASHES and img_dhash(img_buf)
+    if dhash is not None:
+        dupe = PHASHES.find(dhash, PHASH_DIST)
+    if dupe:
+        (rsp, dupe), dist = dupe
+        if debug:
+            print('Reusing Vision API results of near-duplicate %r' % dupe)
+        dupe = 'near-duplicate of %s (%d bits differ)' % (dupe, dist)
+    else:
+        img = vision_shrink(img_buf)
+        if img is None:
+            print('ERROR: %r too big for Vision API and could not be shrunk'
+                    % fname)
+            return
+        if debug and len(img) < len(data):
+            print('Shrunk %r to %d bytes for Vision API' % (fname, len(img)))
+        rsp = vision_annotate_img(img, top, features)
+        if not rsp:
+            return
+        if dhash is not None:
+            PHASHES.add(dhash, (rsp, gcsname))
     if debug:
-        print('Top %d labels from Vision API: %s' % (top, rsp))
+        for feature, cell in zip(features, rsp):
+            print('Vision API %s (top %d): %s' % (feature, top, cell))
 
     # push results to Sheet, get cells-saved count
     fsize = k_ize(len(data))
-    row = [folder,
-            '=HYPERLINK("storage.cloud.google.com/%s/%s", "%s")' % (
-            bucket, gcsname, fname), mtype, ftime, fsize, rsp
-    ]
+    row = [folder, gcs_link(bucket, gcsname, fname), mtype, ftime, fsize
+    ] + rsp + ([dupe or ''] if PHASHES else [])
+    if LABELS and 'labels' in features:
+        LABELS.add(rsp[features.index('labels')], '%s/%s' % (bucket, gcsname),
+                fname, folder, ftime)
+    if ROWS:
+        ROWS.add(sheet_id, row)
+        if debug:
+            print('Queued row for Google Sheet')
+        return row
     rsp = sheet_append_row(sheet_id, row)
     if not rsp:
         return
     if debug:
         print('Added %d cells to Google Sheet' % rsp)
-    return True
+    return row
+
+
+def main_batch(folder_id, bucket, sheet_id, folder, top, debug, shard=None,
+        features=FEATURES, workers=WORKERS, order=ORDER):
+    '"main_batch()" runs "main()" on all (or one shard of) folder images'
+
+    # list images in Drive folder, keeping only this node's shard if given;
+    # Sheets appends from every shard land after the last row, not on it
+    targets = drive_list_imgs(folder_id)
+    if shard:
+        targets = [target for target in targets if in_shard(target['id'], shard)]
+    if debug:
+        print('Found %d image(s) to process' % len(targets))
+
+    # process images (in scheduled order, workers at a time), carrying on
+    # past any that fail; park those stuck behind an open circuit, retrying
+    # them when it may close, giving up after MAX_TRIES rounds in a row
+    # without any getting through
+    done, todo, stuck = 0, targets, 0
+    while todo and stuck < MAX_TRIES:
+        sched = Scheduler(todo, order, workers)
+        ok, parked, waits = [], [], [0]
+
+        def work():
+            while True:
+                target = sched.next()
+                if not target:
+                    return
+                try:
+                    if try_main(target, bucket, sheet_id, folder, top,
+                            debug, features):
+                        ok.append(target)
+                except CircuitOpen as e:
+                    parked.append(target)
+                    waits.append(e.retry_in)
+                except Exception as e:  # keep worker going
+                    print('ERROR: could not process %r: %s' % (target['name'], e))
+                finally:
+                    sched.done(target)
+
+        threads = [threading.Thread(target=work) for i in range(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        before, done, wait = done, done + len(ok), max(waits)
+        if parked:
+            print('Parked %d image(s) for %.1f secs: API unavailable' % (
+                    len(parked), wait))
+            time.sleep(wait)
+        stuck = 0 if done > before else stuck + 1
+        todo = parked
+    for target in todo:
+        print('ERROR: could not process %r (API unavailable)' % target['name'])
+    return done, len(targets)
+
+
+def main_queue(db, bucket, sheet_id, folder, top, debug, lease=LEASE,
+        features=FEATURES):
+    '"main_queue()" runs "main()" on images leased from work queue until empty'
+
+    # take images one at a time so fast workers take more; when none are
+    # ready, wait for other workers' leases to end in case any of them died
+    worker = '%s:%d' % (socket.gethostname(), os.getpid())
+    done = total = 0
+    while True:
+        target = queue_lease(db, worker, lease)
+        if not target:
+            wait = queue_wait(db)
+            if wait is None:
+                return done, total
+            time.sleep(min(wait, 10) + 0.1)
+            continue
+        renewer = LeaseRenewer(db, target['id'], worker, lease)
+        try:
+            rsp = try_main(target, bucket, sheet_id, folder, top, debug, features)
+        except CircuitOpen as e:
+            renewer.stop()
+            queue_park(db, target['id'], worker, e.retry_in)
+            continue
+        except Exception as e:  # keep worker going (image retried, or failed)
+            print('ERROR: could not process %r: %s' % (target['name'], e))
+            rsp = None
+        finally:
+            renewer.stop()
+        total += 1
+        queue_done(db, target['id'], worker, bool(rsp))
+        if rsp:
+            done += 1
+
+
+def main_backfill(src_uri, sheet_id, top, debug, features=FEATURES, out_uri=None):
+    '"main_backfill()" labels images already in GCS via Vision batch operations'
+
+    # list source images, splitting them into batches (1 operation each)
+    bucket, prefix = gcs_split(src_uri)
+    objs = dict(('gs://%s/%s' % (obj['bucket'], obj['name']), obj)
+            for obj in gcs_list_objs(bucket, prefix))
+    uris = sorted(objs)
+    pending = [uris[i:i+BATCH_IMGS] for i in range(0, len(uris), BATCH_IMGS)]
+    out_uri = (out_uri or 'gs://%s/vision-backfill/%s' % (
+            bucket, time.strftime('%Y%m%d-%H%M%S'))).rstrip('/')
+    if debug:
+        print('Found %d image(s) in %d batch(es), output to %s' % (
+                len(uris), len(pending), out_uri))
+
+    # keep up to BATCH_OPS operations running; load results as each finishes
+    running, done, batch = {}, 0, 0
+    while pending or running:
+        while pending and len(running) < BATCH_OPS:
+            batch += 1
+            batch_uri = '%s/batch-%05d/' % (out_uri, batch)
+            uris = pending.pop(0)
+            try:
+                running[vision_batch_submit(uris, top, features,
+                        batch_uri)] = batch_uri, uris
+            except errors.HttpError as e:   # try batch again next round
+                print('WARNING: could not start Vision batch %s (will retry): %s'
+                        % (batch_uri, e))
+                pending.insert(0, uris)
+                break
+        time.sleep(BATCH_POLL)
+        for name in list(running):
+            try:
+                rsp = vision_batch_status(name)
+            except errors.HttpError as e:
+                print('WARNING: could not check Vision batch %s (will retry): %s' % (
+                        running[name][0], e))
+                continue
+            if not rsp.get('done'):
+                continue
+            batch_uri, uris = running.pop(name)
+            if 'error' in rsp:
+                print('ERROR: Vision batch %s failed: %s' % (
+                        batch_uri, rsp['error'].get('message')))
+                continue
+            done += backfill_rows(batch_uri, uris, objs, sheet_id,
+                    top, features, debug)
+    return done, len(objs)
+
 
+def backfill_rows(batch_uri, uris, objs, sheet_id, top, features, debug):
+    'bulk-load Sheet rows from one Vision batch operation output, return #rows'
 
-if __name__ == '__main__':
+    # stream responses (for batch's image URIs), appending SHEET_ROWS at a time
+    rows, total = [], 0
+    for i, rsp in enumerate(vision_batch_results(batch_uri)):
+        uri = rsp.get('context', {}).get('uri') or uris[i]
+        obj = objs.get(uri)
+        cells = [VISION_FEATURES[feature][1](rsp, top) for feature in features]
+        if not (obj and any(cells)):
+            print('ERROR: could not process %r' % uri)
+            continue
+        folder, _, fname = obj['name'].rpartition('/')
+        if LABELS and 'labels' in features:
+            LABELS.add(cells[features.index('labels')], '%s/%s' % (
+                    obj['bucket'], obj['name']), fname, folder, obj.get('updated'))
+        rows.append([folder, gcs_link(obj['bucket'], obj['name'], fname),
+                obj.get('contentType'),
+                obj.get('updated'), k_ize(int(obj.get('size', 0)))
+        ] + cells)
+        if len(rows) >= SHEET_ROWS:
+            total += flush_rows(sheet_id, rows, debug)
+    return total + flush_rows(sheet_id, rows, debug)
+
+
+def flush_rows(sheet_id, rows, debug):
+    'append (then clear) buffered rows to Sheet, return #rows'
+    count = len(rows)
+    if rows:
+        rsp = sheet_add_rows(sheet_id, rows)
+        if debug:
+            print('Added %d cells (%d rows) to Google Sheet' % (rsp or 0, count))
+        del rows[:]
+    return count
+
+
+def main_plan(folder_id, shard=None, workers=WORKERS, features=FEATURES,
+        dedupe=False, bulk=False):
+    '"main_plan()" only lists folder images, estimating what processing takes'
+
+    # exact duplicates (same MD5) are the least --phash (dedupe) would catch
+    listed = drive_list_imgs(folder_id)
+    targets = [t for t in listed if not shard or in_shard(t['id'], shard)]
+    count = len(targets)
+    sizes = [int(t.get('size', 0)) for t in targets]
+    total = sum(sizes)
+    dupes = count - len(set(t.get('md5Checksum') or t['id'] for t in targets))
+    calls = collections.OrderedDict((
+        ('drive', max(1, -(-len(listed)//1000)) + sum(
+                max(1, -(-size//DL_CHUNK)) for size in sizes)),
+        ('gcs', sum(2 * composite_parts(size) + 1 if composite_parts(size) > 1
+                else 1 for size in sizes)),
+        ('vision', count - dupes if dedupe else count),
+        ('sheets', -(-count//SHEET_ROWS) if bulk else count),
+    ))
+
+    # time: workers making calls & moving bytes (download & upload, in
+    # parallel parts if big, base64 to Vision, shrunk if too big), unless
+    # an API's quota is slower still
+    busy = sum(CALL_SECS[api] * n for api, n in calls.items()) + sum((1. /
+            DriveDownload.parts(size) + 1. / composite_parts(size)) * size +
+            4/3. * min(size, VISION_MAX) for size in sizes) / (PLAN_MBPS * (1<<20))
+    limits = [(busy / max(workers, 1), '%d worker(s)' % workers)] + [
+            (calls[api] * 60. / QUOTAS[api], '%s API quota (%d calls/min)' % (
+            api, QUOTAS[api])) for api in calls if QUOTAS.get(api)]
+    secs, bottleneck = max(limits)
+
+    print('Images:     %d (%d exact duplicate(s), %.1f%%)' % (count, dupes,
+            dupes * 100. / max(count, 1)))
+    print('Bytes:      %.2f MB (largest %.2f MB; %d spilled to disk)' % (
+            total / float(1<<20), max(sizes or [0]) / float(1<<20),
+            sum(size > SPILL_SIZE for size in sizes)))
+    for api, n in calls.items():
+        print('%-11s %d call(s)%s' % ({'gcs': 'GCS'}.get(api, api.capitalize()) + ':', n,
+                ', %d feature unit(s)' % (n * len(features)) if api == 'vision' else ''))
+    print('Time:       ~%dh %02dm %02ds, limited by %s' % (secs // 3600,
+            secs % 3600 // 60, secs % 60, bottleneck))
+    return count, total, calls, secs
+
+
+def try_main(target, bucket, sheet_id, folder, top, debug, features=FEATURES):
+    'run "main()" on listed image, reporting (not raising) API errors'
+    # (except CircuitOpen, so caller can park image to retry later)
+    try:
+        rsp = main(target, bucket, sheet_id, folder, top, debug, features)
+    except errors.HttpError as e:
+        rsp = None
+        if debug:
+            print(e)
+    if not rsp:
+        print('ERROR: could not process %r' % target['name'])
+    return rsp
+
+
+class JobServer(ThreadingMixIn, HTTPServer):
+    'local HTTP job-submission API, jobs run by "serve()" worker threads'
+    daemon_threads = True
+
+    def __init__(self, port, settings):
+        HTTPServer.__init__(self, ('127.0.0.1', port), JobHandler)
+        self.settings = settings    # default bucket, Sheet ID, etc., for jobs
+        self.jobs = {}              # job ID: job, oldest dropped past MAX_JOBS
+        self.pending = queue.Queue()
+        self.lock = threading.Lock()
+
+    def submit(self, req):
+        'queue job to process image named (or Drive file ID) in request'
+        job = {'id': uuid.uuid4().hex, 'state': 'queued', 'result': None,
+                'submitted': time.time(), '_done': threading.Event(), '_req': req}
+        with self.lock:
+            while len(self.jobs) >= MAX_JOBS:
+                del self.jobs[min(self.jobs,
+                        key=lambda i: self.jobs[i]['submitted'])]
+            self.jobs[job['id']] = job
+        self.pending.put(job)
+        return job
+
+    def run_jobs(self):
+        'process queued jobs (one at a time per worker) with already-built clients'
+        while True:
+            job = self.pending.get()
+            req = job['_req']
+            settings = dict(self.settings, **dict((k, req[k])
+                    for k in ('bucket', 'sheet_id', 'folder', 'top', 'features')
+                    if k in req))
+            job['state'] = 'running'
+            try:
+                target = req.get('imgfile') or DRIVE.files().get(
+                        fileId=req['file_id'],
+                        fields='id,name,mimeType,modifiedTime,size').execute()
+                job['result'] = main(target, settings['bucket'],
+                        settings['sheet_id'], settings['folder'],
+                        int(settings['top']), settings['debug'],
+                        features_arg(settings['features']))
+                job['state'] = 'done' if job['result'] else 'failed'
+            except CircuitOpen as e:
+                # park job, requeueing it once API circuit may close
+                job['state'] = 'parked'
+                timer = threading.Timer(e.retry_in, self.pending.put, [job])
+                timer.daemon = True
+                timer.start()
+                continue
+            except Exception as e:
+                job['state'], job['error'] = 'failed', str(e)
+            job['_done'].set()
+
+
+class JobHandler(BaseHTTPRequestHandler):
+    'POST /jobs {"imgfile"|"file_id": ..., "wait": bool, ...}; GET /jobs/ID'
+
+    def reply(self, status, body):
+        body = json.dumps(dict((k, v) for k, v in body.items()
+                if not k.startswith('_'))).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/jobs':
+            return self.reply(404, {'error': 'no such endpoint'})
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            req = json.loads(self.rfile.read(length).decode('utf-8') or '{}')
+        except ValueError:
+            return self.reply(400, {'error': 'request body must be JSON'})
+        if not (isinstance(req, dict) and (req.get('imgfile') or req.get('file_id'))):
+            return self.reply(400, {'error': 'need "imgfile" or "file_id"'})
+
+        # return job (result) when done if caller waits, else job ID to poll
+        job = self.server.submit(req)
+        if req.get('wait'):
+            job['_done'].wait()
+            return self.reply(200 if job['state'] == 'done' else 500, job)
+        self.reply(202, job)
+
+    def do_GET(self):
+        job = self.server.jobs.get(self.path.rstrip('/').rsplit('/', 1)[-1])
+        if not (self.path.startswith('/jobs/') and job):
+            return self.reply(404, {'error': 'no such job'})
+        self.reply(200, job)
+
+    def log_message(self, fmt, *args):
+        if self.server.settings['debug']:
+            BaseHTTPRequestHandler.log_message(self, fmt, *args)
+
+
+def serve(port, bucket, sheet_id, folder, top, debug, features=FEATURES,
+        workers=WORKERS):
+    '"serve()" runs "main()" on jobs posted to local API (until interrupted)'
+
+    # API clients & connections stay warm across jobs; requests are taken
+    # concurrently, & jobs started in order, up to workers at a time, so
+    # one slow job doesn't hold up the others
+    server = JobServer(port, {'bucket': bucket, 'sheet_id': sheet_id,
+            'folder': folder, 'top': top, 'debug': debug, 'features': features})
+    for i in range(max(1, workers)):
+        worker = threading.Thread(target=server.run_jobs, name='JobWorker-%d' % i)
+        worker.daemon = True
+        worker.start()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def features_arg(spec):
+    'parse "labels,text,..." Vision features list (or sequence) for a run'
+    features = spec.split(',') if hasattr(spec, 'split') else list(spec)
+    unknown = [f for f in features if f not in VISION_FEATURES]
+    if unknown or not features:
+        raise argparse.ArgumentTypeError('features must be from %s' %
+                ','.join(sorted(VISION_FEATURES)))
+    return tuple(features)
+
+
+def shard_arg(spec):
+    'parse "i/N" shard spec (0 <= i < N) from the command-line'
+    try:
+        index, count = (int(n) for n in spec.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError('shard must be "i/N", not %r' % spec)
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError('shard index must be in [0, %d)' % count)
+    return index, count
+
+
+if __name__ == '__main__' and sys.argv[1:2] == ['query']:
+    # args: query INDEX_DIR -l label [-l label ...] [--min_score 0-1]
+    #       [--folder folder] [-n max images] | query INDEX_DIR --compact
+    parser = argparse.ArgumentParser(prog='%s query' % sys.argv[0],
+            description='search label index (built with --index) for images')
+    parser.add_argument("index", help="label index dir")
+    parser.add_argument("-l", "--label", action="append", default=[],
+            help="label images must have (repeat: must have all)")
+    parser.add_argument("--min_score", type=float, default=0.,
+            help="only labels scored over this (0-1)")
+    parser.add_argument("--folder", help="only images in this folder")
+    parser.add_argument("-n", "--limit", type=int, help="at most this many images")
+    parser.add_argument("--compact", action="store_true",
+            help="merge index files into 1, for faster searches")
+    args = parser.parse_args(sys.argv[2:])
+    if not pyarrow:
+        parser.error('query requires pyarrow')
+    if args.compact:
+        print('Merged %d index file(s)' % LabelIndex(args.index).compact())
+    elif not args.label:
+        parser.error('at least 1 -l/--label required')
+    else:
+        main_query(args.index, args.label, args.min_score, args.folder, args.limit)
+
+elif __name__ == '__main__':
     # args: [-hv] [-i imgfile] [-b bucket] [-f folder] [-s Sheet ID] [-t top labels]
+    #       [-d Drive folder ID [--shard i/N]] [-q queue DB [--lease secs]]
+    #       [--serve port] [--features labels,text,safesearch,colors]
+    #       [--backfill gs://bucket/prefix [--backfill_out gs://bucket/prefix]]
+    #       [--hedge [max %]] [-w workers] [--order fifo|smallest|largest|mixed]
+    #       [--wal pending rows log] [--phash [max bits differing]]
+    #       [--spill MB [--spill_dir dir]] [--rollover [rows]] [--tab_per_folder]
+    #       [--naming folder|hash|date-hash] [--buckets bucket1,bucket2,...]
+    #       [--plan] [--record cassette] [--index label index dir] [--http2]
+    #       [--composite [MB]]
+    #   or: query ... (see above)
     parser = argparse.ArgumentParser()
     parser.add_argument("-i", "--imgfile", action="store_true",
             default=FILE, help="image file filename")
@@ -170,14 +2085,160 @@ if __name__ == '__main__':
             default=TOP, help="return top N (default %d) Vision API labels" % TOP)
     parser.add_argument("-v", "--verbose", action="store_true",
             default=DEBUG, help="verbose display output")
+    parser.add_argument("-d", "--drive_folder", default=FOLDER_ID,
+            help="process all images in this Drive folder (ID) instead")
+    parser.add_argument("--shard", type=shard_arg,
+            help="with -d, only process shard i of N (e.g., 0/4) of images")
+    parser.add_argument("-q", "--queue",
+            help="SQLite work queue file: with -d, queue folder images; "
+            "then process queued images (run as many workers as needed)")
+    parser.add_argument("--lease", type=int, default=LEASE,
+            help="with -q, secs (default %d) before other workers may retry "
+            "an image whose worker died (renewed while it's alive)" % LEASE)
+    parser.add_argument("--features", type=features_arg, default=FEATURES,
+            help="Vision features to save, 1 Sheet column each (default %s; "
+            "from %s)" % (','.join(FEATURES), ','.join(sorted(VISION_FEATURES))))
+    parser.add_argument("--backfill", metavar="GS_URI",
+            help="label images already in GCS (gs://bucket/prefix) with "
+            "offline Vision batch operations instead")
+    parser.add_argument("--backfill_out", metavar="GS_URI",
+            help="with --backfill, where Vision writes results (default "
+            "gs://BUCKET/vision-backfill/TIMESTAMP)")
+    parser.add_argument("-w", "--workers", type=int, default=WORKERS,
+            help="with -d or --serve, process this many (default %d) images "
+            "at once" % WORKERS)
+    parser.add_argument("--order", choices=Scheduler.ORDERS, default=ORDER,
+            help="with -d, order images start in, by size (default %s)" % ORDER)
+    parser.add_argument("--wal", metavar="PATH",
+            help="append rows to Sheet in bulk (%d at a time), logging "
+            "them to PATH until appended, replayed if interrupted" % SHEET_ROWS)
+    parser.add_argument("--phash", type=int, nargs="?", const=PHASH_DIST,
+            metavar="BITS", help="reuse Vision results of near-duplicate "
+            "images (<= BITS, default %d, of 64-bit image hashes differ); "
+            "needs numpy & Pillow" % PHASH_DIST)
+    parser.add_argument("--spill", type=float, metavar="MB",
+            default=SPILL_SIZE/float(1<<20), help="keep images up to MB "
+            "(default %d) in memory, spill bigger ones to disk" % (SPILL_SIZE>>20))
+    parser.add_argument("--spill_dir", default=SPILL_DIR,
+            help="dir for spilled images (default: system temp dir)")
+    parser.add_argument("--composite", type=float, nargs="?",
+            const=COMPOSITE_MB, metavar="MB", help="upload images over MB "
+            "(default %d) to GCS in up to %d parallel parts, then compose "
+            "them into 1 object" % (COMPOSITE_MB, UL_PARTS))
+    parser.add_argument("--rollover", type=int, nargs="?",
+            const=SHEET_MAX_ROWS, metavar="ROWS", help="start a new tab "
+            "(or Sheet, if full) every ROWS (default %d) rows, listed in "
+            "an Index tab" % SHEET_MAX_ROWS)
+    parser.add_argument("--tab_per_folder", action="store_true",
+            help="put each folder's rows in its own tab(s), listed in an Index tab")
+    parser.add_argument("--naming", choices=('folder', 'hash', 'date-hash'),
+            default=NAMING, help="GCS object names: FOLDER/FILE, or with a "
+            "hashed (or DATE/hashed) prefix to spread heavy writes (default %s)"
+            % NAMING)
+    parser.add_argument("--buckets", type=lambda spec: tuple(spec.split(',')),
+            default=BUCKETS, help="spread images across these GCS buckets "
+            "(comma-separated) instead")
+    parser.add_argument("--plan", action="store_true",
+            help="with -d, only list images, estimating API calls & time "
+            "processing them (with these options) would take")
+    parser.add_argument("--record", metavar="CASSETTE",
+            help="record API calls & replies (gzip-ed, image data by size "
+            "only) for replaying with loadtest.py --replay")
+    parser.add_argument("--http2", action="store_true",
+            help="call Google APIs over a few shared (multiplexed) HTTP/2 "
+            "connections instead of 1 HTTP/1.1 connection per thread; "
+            "needs httpx & h2")
+    parser.add_argument("--index", metavar="DIR",
+            help="also save labels to a local search index (see \"query "
+            "-h\"); needs pyarrow")
+    parser.add_argument("--hedge", type=float, nargs="?", const=HEDGE_PCT,
+            metavar="PCT", help="resend slow Drive & Vision calls, up to PCT "
+            "(default %d) %% more calls" % HEDGE_PCT)
+    parser.add_argument("--serve", type=int, metavar="PORT",
+            help="run as service taking jobs at http://127.0.0.1:PORT/jobs")
     args = parser.parse_args()
+    if args.shard and not args.drive_folder:
+        parser.error('--shard requires -d/--drive_folder')
+    if args.plan and not args.drive_folder:
+        parser.error('--plan requires -d/--drive_folder')
+    SPILL_SIZE, SPILL_DIR = int(args.spill * (1<<20)), args.spill_dir
+    if args.composite is not None:
+        COMPOSITE = int(args.composite * (1<<20))
+    if args.http2 and not httpx:
+        parser.error('--http2 requires httpx & h2 (pip install httpx[http2])')
+    creds = authorize()
+    HTTP = creds.authorize(Http2()) if args.http2 else ThreadLocalHttp(creds)
+    if args.record:
+        HTTP = Recorder(HTTP, args.record)
+    DRIVE, GCS, VISION, SHEETS = build_apis(HTTP)
+    NAMING, BUCKETS = args.naming, args.buckets
+    if args.rollover or args.tab_per_folder:
+        ROLLOVER = SheetRoller(args.rollover or SHEET_MAX_ROWS,
+                args.tab_per_folder)
+    if args.hedge:
+        HEDGER = Hedger(args.hedge, args.workers)
+    if args.wal and not args.plan:
+        ROWS = RowBuffer(args.wal, args.verbose)
+    if args.index:
+        if not pyarrow:
+            parser.error('--index requires pyarrow')
+        LABELS = LabelIndex(args.index)
+    if args.phash is not None:
+        if not numpy:
+            parser.error('--phash requires numpy & Pillow (PIL)')
+        PHASH_DIST, PHASHES = args.phash, BKTree()
 
-    print('Processing file %r... please wait' % args.imgfile)
-    rsp = main(args.imgfile, args.bucket_id,
-            args.sheet_id, args.folder, args.viz_top, args.verbose)
+    if args.plan:
+        print('Planning Drive folder %r (listing only)... please wait' %
+                args.drive_folder)
+        main_plan(args.drive_folder, args.shard, args.workers, args.features,
+                args.phash is not None, bool(args.wal))
+        rsp = None
+    elif args.serve:
+        print('Serving jobs at http://127.0.0.1:%d/jobs... Ctrl-C to quit' % args.serve)
+        serve(args.serve, args.bucket_id, args.sheet_id, args.folder,
+                args.viz_top, args.verbose, args.features, args.workers)
+        rsp = None
+    elif args.backfill:
+        print('Backfilling %r... please wait' % args.backfill)
+        done, total = main_backfill(args.backfill, args.sheet_id, args.viz_top,
+                args.verbose, args.features, args.backfill_out)
+        print('Processed %d of %d image(s)' % (done, total))
+        rsp = done
+    elif args.queue:
+        db = queue_open(args.queue)
+        if args.drive_folder:
+            targets = drive_list_imgs(args.drive_folder)
+            if args.shard:
+                targets = [t for t in targets if in_shard(t['id'], args.shard)]
+            print('Queued %d new image(s) from Drive folder %r' % (
+                    queue_put(db, targets), args.drive_folder))
+        print('Processing queue %r... please wait' % args.queue)
+        done, total = main_queue(db, args.bucket_id, args.sheet_id, args.folder,
+                args.viz_top, args.verbose, args.lease, args.features)
+        print('Processed %d of %d image(s)' % (done, total))
+        rsp = done
+    elif args.drive_folder:
+        print('Processing Drive folder %r... please wait' % args.drive_folder)
+        done, total = main_batch(args.drive_folder, args.bucket_id, args.sheet_id,
+                args.folder, args.viz_top, args.verbose, args.shard, args.features,
+                args.workers, args.order)
+        print('Processed %d of %d image(s)' % (done, total))
+        rsp = done
+    else:
+        print('Processing file %r... please wait' % args.imgfile)
+        rsp = main(args.imgfile, args.bucket_id, args.sheet_id,
+                args.folder, args.viz_top, args.verbose, args.features)
+    if ROWS:
+        ROWS.close()
+    if args.record:
+        HTTP.close()
+    if LABELS:
+        LABELS.close()
     if rsp:
         sheet_url = 'https://docs.google.com/spreadsheets/d/%s/edit' % args.sheet_id
         print('DONE: opening web browser to it, or see %s' % sheet_url)
         webbrowser.open(sheet_url, new=1, autoraise=True)
-    else:
+    elif not (args.plan or args.serve or args.backfill or args.drive_folder
+            or args.queue):
         print('ERROR: could not process %r' % args.imgfile)
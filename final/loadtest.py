@@ -0,0 +1,777 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+loadtest.py - load-test analyze_gsimg.py against local fake Google APIs
+
+Run local HTTP stand-ins for the Drive, Cloud Storage, Vision, and Sheets
+APIs (with configurable latency, errors, 429s, and quotas), then run the
+real analyze_gsimg.py batch pipeline against them, reporting throughput,
+latency percentiles, and resource use. No network or credentials needed.
+'''
+
+from __future__ import print_function
+import argparse
+import base64
+import collections
+import gzip
+import hashlib
+import io
+import json
+import math
+import os
+import random
+import re
+import resource
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zlib
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, unquote, urlsplit
+except ImportError:     # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib import unquote
+    from urlparse import parse_qs, urlsplit
+try:    # optional: CRC32Cs of fake GCS objects (for --composite)
+    import google_crc32c
+except ImportError:
+    google_crc32c = None
+try:    # optional: fake images start with a real JPEG (shrunk for Vision)
+    from PIL import Image
+except ImportError:
+    Image = None
+
+from httplib2 import Http, Response
+
+APIS = ('drive', 'gcs', 'vision', 'sheets')
+IMAGES = 1000     # IMAGES IN FAKE DRIVE FOLDER
+IMG_MB = 2.       # MEDIAN IMAGE SIZE (MB; sizes are log-normal)
+IMG_SIGMA = .8    # SPREAD OF (LOG) IMAGE SIZES
+IMG_MAX = 50 << 20  # LARGEST IMAGE (BYTES)
+COMPOSITE_IMG_MAX = 256 << 20  # LARGEST IMAGE (BYTES) WITH --composite
+LATENCY = {       # API: (MEDIAN SECS, SPREAD) OF (LOG-NORMAL) FAKE LATENCIES
+    'drive': (.05, .5), 'gcs': (.1, .5), 'vision': (.5, .5), 'sheets': (.2, .5),
+}
+BLOCK = 1 << 20   # BYTES OF RANDOM DATA REPEATED FOR FAKE IMAGE CONTENT
+VISION_REQ_MAX = 10 << 20  # BIGGEST VISION REQUEST (BYTES) FAKES TAKE, AS VISION
+FOLDER_ID = 'loadtest-folder'
+BUCKET = 'loadtest-bucket'
+SHEET = 'loadtest-sheet'
+BACKFILL = 'backfill/'  # GCS PREFIX OF FAKE IMAGES (COPIES) FOR --backfill
+BACKFILL_IMGS = 100     # IMAGES PER VISION BATCH OPERATION WITH --backfill
+BACKFILL_POLL = .5      # SECS BETWEEN BATCH OPERATION CHECKS WITH --backfill
+OP_NAMES = ('projects/loadtest/operations/%d',  # FORMS OF BATCH OPERATION
+        'projects/loadtest/locations/us/operations/%d', 'operations/%d')  # NAMES
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def percentiles(values, pcts=(50, 90, 99)):
+    'return "p50 0.12s p90 ..." for values (secs)'
+    values = sorted(values)
+    if not values:
+        return 'n/a'
+    return ' '.join('p%d %.3fs' % (pct, values[min(len(values)-1,
+            int(len(values) * pct / 100.))]) for pct in pcts) + \
+            ' max %.3fs' % values[-1]
+
+
+def fake_images(count, img_mb=IMG_MB, seed=0, img_max=IMG_MAX):
+    'return Drive file info for fake folder of count images'
+    rand = random.Random(seed)
+    images = []
+    for i in range(count):
+        size = min(img_max, max(1, int(rand.lognormvariate(
+                math.log(img_mb * (1<<20)), IMG_SIGMA))))
+        images.append({'id': 'img%06d' % i, 'name': 'img%06d.jpg' % i,
+                'mimeType': 'image/jpeg', 'size': str(size),
+                'modifiedTime': '2020-06-01T00:00:00.000Z',
+                'md5Checksum': hashlib.md5(str(i).encode('utf-8')).hexdigest()})
+    return images
+
+
+def fake_jpeg(size=(640, 480)):
+    'return (random) JPEG image data fake images start with (b"" w/o Pillow)'
+    if not Image:
+        return b''
+    out = io.BytesIO()
+    Image.frombytes('RGB', size, os.urandom(size[0] * size[1] * 3)).save(
+            out, 'JPEG')
+    return out.getvalue()
+
+
+def fake_annotation():
+    'return Vision response with every feature: unused ones are ignored'
+    return {
+        'labelAnnotations': [{'description': 'label %d' % i,
+                'score': 1 - i/20.} for i in range(10)],
+        'textAnnotations': [{'description': 'fake text'}],
+        'safeSearchAnnotation': dict((k, 'VERY_UNLIKELY') for k in (
+                'adult', 'spoof', 'medical', 'violence', 'racy')),
+        'imagePropertiesAnnotation': {'dominantColors': {'colors': [
+                {'color': {'red': 16*i, 'green': 8*i, 'blue': 4*i},
+                'pixelFraction': .1} for i in range(5)]}},
+    }
+
+
+class FakeApis(ThreadingMixIn, HTTPServer):
+    'local stand-ins for the Drive, GCS, Vision, & Sheets API calls used'
+    daemon_threads = True
+
+    def __init__(self, port, images, latency=LATENCY, errors=None,
+            throttle=None, quotas=None, mbps=None):
+        HTTPServer.__init__(self, ('127.0.0.1', port), FakeApiHandler)
+        self.images = images
+        self.by_id = dict((image['id'], image) for image in images)
+        self.latency = latency      # API: (median secs, spread)
+        self.errors = errors or {}  # API: % calls failing (500)
+        self.throttle = throttle or {}  # API: % calls throttled (429)
+        self.quotas = quotas or {}  # API: calls/min, then 429s
+        self.mbps = mbps            # MB/sec per connection moving image data
+        self.objects = dict(((BUCKET, BACKFILL + image['name']), (
+                int(image['size']), None, None)) for image in images)
+                            # (bucket, name): (size, CRC32C, data if kept)
+        self.ops = {}       # batch operation name: [checks, body]
+        self.composed = collections.Counter()   # objects, parts
+        self.calls = collections.defaultdict(collections.deque)  # in last min
+        self.status = collections.defaultdict(collections.Counter)
+        self.block = bytearray(os.urandom(BLOCK))
+        jpeg = fake_jpeg()  # (rest is ignored by JPEG decoders)
+        self.block[:len(jpeg)] = jpeg
+        self.lock = threading.Lock()
+
+    def admit(self, api):
+        'return HTTP status for call to API: 200, or an injected 429 or 500'
+        now = time.time()
+        with self.lock:
+            calls = self.calls[api]
+            while calls and calls[0] < now - 60:
+                calls.popleft()
+            if self.quotas.get(api) and len(calls) >= self.quotas[api]:
+                status = 429
+            else:
+                calls.append(now)
+                pct = random.random() * 100
+                status = 500 if pct < self.errors.get(api, 0) else \
+                        429 if pct < self.errors.get(api, 0) + \
+                        self.throttle.get(api, 0) else 200
+            self.status[api][status] += 1
+        return status
+
+    def wait(self, api):
+        'sleep for (random) latency of API call'
+        median, spread = self.latency.get(api, (0, 0))
+        if median:
+            time.sleep(random.lognormvariate(math.log(median), spread))
+
+
+class FakeApiHandler(BaseHTTPRequestHandler):
+    'fake Google API calls, routed by URL path (whatever the host)'
+    protocol_version = 'HTTP/1.1'   # keep connections open, like the real APIs
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_api()
+
+    def do_POST(self):
+        self.handle_api()
+
+    def do_DELETE(self):
+        self.handle_api()
+
+    def handle_api(self):
+        url = urlsplit(self.path)
+        query = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+        body = self.read_body(int(self.headers.get('content-length') or 0))
+        api = route(url.path)
+        if not api:
+            return self.reply(404, error='no fake for %s' % url.path)
+        self.server.wait(api)
+        status = self.server.admit(api)
+        if status != 200:
+            return self.reply(status, error='injected %d' % status)
+        getattr(self, api)(url.path, query, body)
+
+    def read_body(self, size):
+        'read request body (image uploads paced, like downloads)'
+        chunks, began, got = [], time.time(), 0
+        while got < size:
+            chunk = self.rfile.read(min(BLOCK, size - got))
+            if not chunk:
+                break
+            chunks.append(chunk)
+            got += len(chunk)
+            self.pace(began, got)
+        return b''.join(chunks)
+
+    def reply(self, status=200, rsp=None, error=None):
+        if error:
+            rsp = {'error': {'code': status, 'message': error}}
+        data = b'' if status == 204 else json.dumps(rsp or {}).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def drive(self, path, query, body):
+        file_id = path.rpartition('/files')[2].strip('/')
+        if not file_id:     # list: folder's images or by name
+            images = self.server.images
+            if "name='" in query.get('q', ''):
+                name = query['q'].split("name='", 1)[1].rstrip("'")
+                images = [image for image in images if image['name'] == name]
+            start = int(query.get('pageToken', 0))
+            end = start + int(query.get('pageSize', 100))
+            rsp = {'files': images[start:end]}
+            if end < len(images):
+                rsp['nextPageToken'] = str(end)
+            return self.reply(rsp=rsp)
+        image = self.server.by_id.get(file_id)
+        if not image:
+            return self.reply(404, error='no file %s' % file_id)
+        if query.get('alt') != 'media':
+            return self.reply(rsp=image)
+        self.media(int(image['size']))
+
+    def media(self, size):
+        # (ranged) download of image content: random block, repeated
+        start, end = 0, size - 1
+        rng = self.headers.get('range', '')
+        if rng.startswith('bytes='):
+            start, _, end = rng[6:].partition('-')
+            start, end = int(start), min(int(end or size - 1), size - 1)
+        if start >= size:   # (image smaller than caller thought)
+            self.send_response(416)
+            self.send_header('Content-Range', 'bytes */%d' % size)
+            self.send_header('Content-Length', '0')
+            return self.end_headers()
+        self.send_response(206 if rng else 200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(end - start + 1))
+        if rng:
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, size))
+        self.end_headers()
+        block = memoryview(self.server.block)
+        began, sent = time.time(), 0
+        while start <= end:
+            offset = start % BLOCK
+            chunk = block[offset:offset + min(BLOCK - offset, end - start + 1)]
+            self.wfile.write(chunk)
+            start += len(chunk)
+            sent += len(chunk)
+            self.pace(began, sent)
+
+    def pace(self, began, nbytes):
+        'sleep as needed to keep image transfer under per-connection MB/sec'
+        if self.server.mbps:
+            time.sleep(max(0, nbytes / (self.server.mbps * (1<<20)) -
+                    (time.time() - began)))
+
+    def gcs(self, path, query, body):
+        bucket, _, name = path.split('/b/', 1)[1].partition('/o')
+        name = unquote(name.strip('/'))
+        objects, lock = self.server.objects, self.server.lock
+        if self.command == 'GET':
+            return self.gcs_get(bucket, name, query)
+        if self.command == 'DELETE':
+            with lock:
+                found = objects.pop((bucket, name), None)
+            return self.reply(204) if found else self.reply(404,
+                    error='no object %s' % name)
+        rsp, crc = {'bucket': bucket}, None
+        data = None     # kept for parts (asked for CRC32C) until deleted
+        if name.endswith('/compose'):   # CRC32C of parts' data, concatenated
+            name = name[:-len('/compose')]
+            with lock:
+                parts = [objects.get((bucket, src['name'])) for src in
+                        json.loads(body.decode('utf-8'))['sourceObjects']]
+            if None in parts:
+                return self.reply(404, error='no source object to compose')
+            with lock:
+                self.server.composed.update(objects=1, parts=len(parts))
+            size = sum(part[0] for part in parts)
+            if google_crc32c and None not in (part[2] for part in parts):
+                crc = 0
+                for part in parts:
+                    crc = google_crc32c.extend(crc, part[2])
+        else:
+            name, size = query.get('name'), len(body)
+            if 'md5Hash' in query.get('fields', ''):
+                rsp['md5Hash'] = base64.b64encode(
+                        hashlib.md5(body).digest()).decode('ascii')
+            if google_crc32c and 'crc32c' in query.get('fields', ''):
+                crc, data = google_crc32c.value(body), body
+        if crc is not None:
+            rsp['crc32c'] = base64.b64encode(struct.pack('>I', crc)).decode(
+                    'ascii')
+        with lock:
+            objects[bucket, name] = size, crc, data
+        rsp.update(name=name, size=str(size))
+        self.reply(rsp=rsp)
+
+    def gcs_get(self, bucket, name, query):
+        # list objects (with prefix), or download one kept (batch output)
+        with self.server.lock:
+            objects = sorted((key[1], obj) for key, obj in
+                    self.server.objects.items() if key[0] == bucket)
+        if not name:
+            prefix = query.get('prefix', '')
+            return self.reply(rsp={'items': [{'bucket': bucket, 'name': key,
+                    'size': str(obj[0]), 'updated': '2020-06-01T00:00:00.000Z',
+                    'contentType': 'image/jpeg' if key.endswith('.jpg') else
+                    'application/json'} for key, obj in objects
+                    if key.startswith(prefix)]})
+        data = dict(objects).get(name, (0, None, None))[2]
+        if query.get('alt') != 'media' or data is None:
+            return self.reply(404, error='no fake for %s' % name)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def vision(self, path, query, body):
+        if path.endswith(':asyncBatchAnnotate'):
+            with self.server.lock:
+                name = OP_NAMES[len(self.server.ops) % len(OP_NAMES)] % len(
+                        self.server.ops)
+                self.server.ops[name] = [0, json.loads(body.decode('utf-8'))]
+            return self.reply(rsp={'name': name})
+        if '/operations/' in path:
+            return self.batch_status(path.split('/', 2)[2])
+        if len(body) > VISION_REQ_MAX:
+            return self.reply(400, error='Request payload size exceeds the '
+                    'limit: %d bytes.' % VISION_REQ_MAX)
+        self.reply(rsp={'responses': [fake_annotation()]})
+
+    def batch_status(self, name):
+        # batch operations finish on their 2nd check, writing output files
+        with self.server.lock:
+            op = self.server.ops.get(name)
+            if op:
+                op[0] += 1
+        if not op:
+            return self.reply(404, error='no operation %s' % name)
+        if op[0] == 2:
+            self.batch_output(op[1])
+        self.reply(rsp={'name': name, 'done': op[0] >= 2})
+
+    def batch_output(self, body):
+        # "output-1-to-N.json" files of batchSize responses each, as Vision's
+        out = body['outputConfig']
+        bucket, _, prefix = out['gcsDestination']['uri'][5:].partition('/')
+        reqs, size = body['requests'], out.get('batchSize', 20)
+        for i in range(0, len(reqs), size):
+            data = json.dumps({'responses': [dict(fake_annotation(), context={
+                    'uri': req['image']['source']['imageUri']})
+                    for req in reqs[i:i+size]]}).encode('utf-8')
+            name = '%soutput-%d-to-%d.json' % (prefix, i + 1,
+                    min(i + size, len(reqs)))
+            with self.server.lock:
+                self.server.objects[bucket, name] = len(data), None, data
+
+    def sheets(self, path, query, body):
+        if not path.endswith(':append'):
+            return self.reply(404, error='no fake for %s' % path)
+        rows = json.loads(body.decode('utf-8')).get('values', [])
+        self.reply(rsp={'updates': {'updatedRows': len(rows),
+                'updatedCells': sum(len(row) for row in rows)}})
+
+
+def route(path):
+    'return API (in APIS) a request URL path is for'
+    if path.startswith(('/upload/storage/', '/storage/')):
+        return 'gcs'
+    if path.startswith('/drive/'):
+        return 'drive'
+    if path.startswith(('/v1/images:', '/v1/projects/', '/v1/operations/')):
+        return 'vision'
+    if path.startswith('/v4/spreadsheets'):
+        return 'sheets'
+
+
+class LocalHttp(object):
+    'per-thread Http sending Google API requests to fakes, timing each call'
+
+    def __init__(self, base, shared=None):
+        self.base = base.rstrip('/')
+        self.shared = shared    # 1 (threadsafe) Http for all, e.g., Http2
+        self.local = threading.local()
+        self.latency = collections.defaultdict(list)    # API: [secs]
+        self.status = collections.defaultdict(collections.Counter)
+
+    def request(self, uri, method='GET', body=None, headers=None, *args, **kwargs):
+        http = self.shared or getattr(self.local, 'http', None)
+        if http is None:
+            http = self.local.http = Http()
+        url = urlsplit(uri)
+        api = route(url.path)
+        start = time.time()
+        rsp = http.request('%s%s?%s' % (self.base, url.path, url.query),
+                method, body, headers, *args, **kwargs)
+        self.latency[api].append(time.time() - start)
+        self.status[api][rsp[0].status] += 1
+        return rsp
+
+
+def request_key(method, uri):
+    'return key matching replayed requests to recorded ones'
+    url = urlsplit(uri)
+    query = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+    path = re.sub(r'~\d+', '', url.path)  # IDs of multiplied Drive images
+    if path.startswith('/drive/'):  # same file, page, or name search
+        search = query.get('q', '') if "name='" in query.get('q', '') else ''
+        return (method, path, query.get('alt', ''), query.get('pageToken', ''),
+                search)
+    # other calls: any recorded reply to the same kind of call will do
+    parts = path.split('/')
+    return method, parts[1], parts[2], parts[-1].rpartition(':')[2]
+
+
+class Player(object):
+    'Http replaying a cassette (analyze_gsimg.py --record), timing each call'
+
+    def __init__(self, path, timing='recorded', multiply=1):
+        self.timing = timing        # 'recorded' latencies, or 'fast' as can be
+        self.multiply = multiply    # copies of each image in Drive listings
+        self.replies = collections.defaultdict(list)   # request key: [entry]
+        self.used = collections.Counter()   # request key: #replayed
+        self.latency = collections.defaultdict(list)    # API: [secs]
+        self.status = collections.defaultdict(collections.Counter)
+        self.lock = threading.Lock()
+        self.jpeg = fake_jpeg()
+        with gzip.open(path, 'rb') as cassette:
+            try:
+                for line in cassette:
+                    entry = json.loads(line.decode('utf-8'))
+                    self.replies[request_key(entry['method'],
+                            entry['uri'])].append(entry)
+            except (EOFError, IOError, ValueError, zlib.error):
+                pass    # recording was cut short: use what's there
+
+    def request(self, uri, method='GET', body=None, headers=None, *args, **kwargs):
+        key = request_key(method, uri)
+        with self.lock:
+            entries = self.replies.get(key)
+            n = self.used[key]
+            self.used[key] += 1
+        start = time.time()
+        if entries:     # cycle through recorded replies, if more requests
+            entry = entries[n % len(entries)]
+            if self.timing == 'recorded':
+                time.sleep(entry['secs'])
+            rsp = self.reply(entry, headers or {})
+        else:
+            rsp = Response({'status': '404'}), b'{"error": {"code": 404}}'
+        api = route(urlsplit(uri).path)
+        self.latency[api].append(time.time() - start)
+        self.status[api][rsp[0].status] += 1
+        return rsp
+
+    def reply(self, entry, headers):
+        info = dict(entry['headers'], status=str(entry['status']))
+        if 'body' in entry:
+            content = entry['body']
+            if self.multiply > 1 and '"files"' in content:
+                content = json.dumps(self.multiplied(json.loads(content)))
+            content = content.encode('utf-8')
+        else:   # media: as many (zero) bytes as recorded, for range asked
+                # for, after a JPEG (so big images are shrunk for Vision)
+            total = int(info.get('content-range', '/%d' % entry['size'])
+                    .rpartition('/')[2])
+            start, end = 0, total - 1
+            rng = headers.get('range', '')
+            if rng.startswith('bytes='):
+                start, _, end = rng[6:].partition('-')
+                start, end = int(start), min(int(end or total - 1), total - 1)
+                info['status'] = '206' if start < total else '416'
+                info['content-range'] = 'bytes %d-%d/%d' % (start, end, total) \
+                        if start < total else 'bytes */%d' % total
+            content = bytearray(max(0, end - start + 1))
+            jpeg = self.jpeg[start:start + len(content)]
+            content[:len(jpeg)] = jpeg
+            content = bytes(content)
+        info['content-length'] = str(len(content))
+        return Response(info), content
+
+    def multiplied(self, rsp):
+        # Drive listing with copies of each image ("~N" IDs map back to it)
+        rsp['files'] = [dict(info, id='%s~%d' % (info['id'], k),
+                name='%d-%s' % (k, info['name'])) if k else info
+                for k in range(self.multiply) for info in rsp['files']]
+        return rsp
+
+
+def open_sockets():
+    'return # of sockets open in this process (None if unknown: not Linux)'
+    try:
+        fds = os.listdir('/proc/self/fd')
+    except OSError:
+        return None
+    count = 0
+    for fd in fds:
+        try:
+            count += os.readlink('/proc/self/fd/' + fd).startswith('socket:')
+        except OSError:     # closed since listed
+            pass
+    return count
+
+
+class Sampler(object):
+    'sample thread & socket counts (peak) while pipeline runs'
+
+    def __init__(self, every=.5):
+        self.peak_threads = 0
+        self.peak_sockets = None
+        self.running = True
+        self.thread = threading.Thread(target=self._run, args=(every,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self, every):
+        while self.running:
+            self.peak_threads = max(self.peak_threads, threading.active_count())
+            sockets = open_sockets()
+            if sockets is not None:
+                self.peak_sockets = max(self.peak_sockets or 0, sockets)
+            time.sleep(every)
+
+    def stop(self):
+        self.running = False
+
+
+def import_gsimg():
+    'import analyze_gsimg.py (API clients built by run(), so no OAuth2 needed)'
+    sys.path.insert(0, HERE)
+    import analyze_gsimg
+    return analyze_gsimg
+
+
+def run(gsimg, http, workers, order, features, backfill=False):
+    'run batch (or backfill) pipeline on fake images via http, return report lines'
+
+    # every API client built by analyze_gsimg goes to the fakes instead
+    gsimg.DRIVE, gsimg.GCS, gsimg.VISION, gsimg.SHEETS = gsimg.build_apis(http)
+
+    # time each image end-to-end
+    main, times, nbytes = gsimg.main, [], [0]
+    def timed_main(target, *args):
+        start = time.time()
+        try:
+            return main(target, *args)
+        finally:
+            times.append(time.time() - start)
+            nbytes[0] += int(target.get('size', 0))
+    gsimg.main = timed_main
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    sampler = Sampler()
+    start = time.time()
+    try:
+        if backfill:    # same images, already in GCS
+            done, total = gsimg.main_backfill('gs://%s/%s' % (BUCKET, BACKFILL),
+                    SHEET, gsimg.TOP, False, features)
+        else:
+            done, total = gsimg.main_batch(FOLDER_ID, BUCKET, SHEET, 'loadtest',
+                    gsimg.TOP, False, None, features, workers, order)
+        if gsimg.ROWS:
+            gsimg.ROWS.close()
+    finally:
+        secs = time.time() - start
+        sampler.stop()
+        gsimg.main = main
+    after = resource.getrusage(resource.RUSAGE_SELF)
+
+    # RSS is in KB on Linux, bytes on macOS
+    rss = after.ru_maxrss / (1024. if sys.platform != 'darwin' else 1024.**2)
+    lines = [
+        'Images:     %d of %d processed in %.1fs: %.1f images/sec, %.1f MB/sec'
+                % (done, total, secs, done / secs, nbytes[0] / secs / (1<<20)),
+    ]
+    if times:
+        lines.append('Per image:  %s' % percentiles(times))
+    for api in APIS:
+        lines.append('%-11s %d call(s), %s; %s' % (
+                {'gcs': 'GCS'}.get(api, api.capitalize()) + ':',
+                len(http.latency[api]), percentiles(http.latency[api]),
+                ', '.join('%s: %d' % kv for kv in sorted(http.status[api].items()))))
+    lines.append('Resources:  CPU %.1fs user, %.1fs sys; max RSS %.0f MB; '
+            'peak threads %d' % (after.ru_utime - usage.ru_utime,
+            after.ru_stime - usage.ru_stime, rss, sampler.peak_threads))
+    if sampler.peak_sockets is not None:    # in-process fakes' included
+        lines[-1] += '; peak sockets %d' % sampler.peak_sockets
+    return lines
+
+
+def api_arg(spec, value=float):
+    'parse "api=value,..." (e.g., "vision=2,sheets=0.5") into dict'
+    rsp = {}
+    try:
+        for item in spec.split(','):
+            api, _, val = item.partition('=')
+            if api not in APIS:
+                raise ValueError(api)
+            rsp[api] = value(val)
+    except ValueError:
+        raise argparse.ArgumentTypeError('must be "API=value,..." for APIs %s'
+                % ','.join(APIS))
+    return rsp
+
+
+def latency_arg(spec):
+    'parse "api=median[:spread],..." latencies into dict'
+    def parse(val):
+        median, _, spread = val.partition(':')
+        return float(median), float(spread or .5)
+    return api_arg(spec, parse)
+
+
+if __name__ == '__main__':
+    # args: [-n images] [--img_mb MB] [-w workers] [--order ...] [--features ...]
+    #       [--latency api=median[:spread],...] [--errors api=%,...]
+    #       [--throttle api=%,...] [--quota api=calls/min,...] [--mbps MB/sec]
+    #       [--hedge [%]] [--wal] [--spill MB] [--http2] [--composite [MB]]
+    #       [--backfill] [--seed N]
+    #       [--serve_fakes port | --fakes URL |
+    #        --replay cassette [--timing recorded|fast] [--multiply N]]
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument("-n", "--images", type=int, default=IMAGES,
+            help="images in fake Drive folder (default %d)" % IMAGES)
+    parser.add_argument("--img_mb", type=float, default=IMG_MB,
+            help="median image size, MB (default %.1f)" % IMG_MB)
+    parser.add_argument("-w", "--workers", type=int, default=8,
+            help="images processed at once (default 8)")
+    parser.add_argument("--order", default='fifo',
+            help="order images start in (see analyze_gsimg.py --order)")
+    parser.add_argument("--features", default='labels',
+            help="Vision features to save (see analyze_gsimg.py --features)")
+    parser.add_argument("--latency", type=latency_arg, default={},
+            help="fake API latencies, median secs[:spread] (log-normal), "
+            "e.g., vision=1.5:0.8 (defaults: %s)" % ', '.join('%s=%s:%s' % (
+            api, LATENCY[api][0], LATENCY[api][1]) for api in APIS))
+    parser.add_argument("--errors", type=api_arg, default={},
+            help="%% of calls failing with 500s, e.g., vision=2")
+    parser.add_argument("--throttle", type=api_arg, default={},
+            help="%% of calls failing with 429s, e.g., sheets=5")
+    parser.add_argument("--quota", type=lambda spec: api_arg(spec, int),
+            default={}, help="calls/min allowed, then 429s, e.g., sheets=60")
+    parser.add_argument("--mbps", type=float,
+            help="cap image data moved per connection at MB/sec")
+    parser.add_argument("--hedge", type=float, nargs="?", const=5,
+            metavar="PCT", help="hedge slow Drive & Vision calls (see "
+            "analyze_gsimg.py --hedge)")
+    parser.add_argument("--wal", action="store_true",
+            help="append Sheet rows in bulk (see analyze_gsimg.py --wal)")
+    parser.add_argument("--spill", type=float, metavar="MB",
+            help="spill images over MB to disk (see analyze_gsimg.py --spill)")
+    parser.add_argument("--http2", action="store_true",
+            help="share 1 httpx transport among workers (see analyze_gsimg.py "
+            "--http2; HTTP/1.1 keep-alive with the fakes)")
+    parser.add_argument("--composite", type=float, nargs="?", const=150,
+            metavar="MB", help="upload images over MB in parallel parts (see "
+            "analyze_gsimg.py --composite)")
+    parser.add_argument("--ul_part", type=float, metavar="MB",
+            help="with --composite, min MB per part (smaller than "
+            "analyze_gsimg.py's, to test composites with smaller images)")
+    parser.add_argument("--backfill", action="store_true",
+            help="run Vision batch operations on the images (copies) in GCS "
+            "instead (see analyze_gsimg.py --backfill)")
+    parser.add_argument("--seed", type=int, default=0,
+            help="random seed for fake image sizes")
+    parser.add_argument("--serve_fakes", type=int, metavar="PORT",
+            help="only run fake APIs (at http://127.0.0.1:PORT), so they "
+            "don't share CPU with a pipeline run with --fakes")
+    parser.add_argument("--fakes", metavar="URL",
+            help="use fake APIs already running (--serve_fakes) at URL")
+    parser.add_argument("--replay", metavar="CASSETTE",
+            help="replay API replies recorded with analyze_gsimg.py --record "
+            "instead of using fake APIs")
+    parser.add_argument("--timing", choices=('recorded', 'fast'),
+            default='recorded', help="with --replay, reply after recorded "
+            "latencies (default) or right away")
+    parser.add_argument("--multiply", type=int, default=1, metavar="N",
+            help="with --replay, list each recorded image N times, to "
+            "simulate a bigger library")
+    args = parser.parse_args()
+
+    latency = dict(LATENCY, **args.latency)
+    workdir = tempfile.mkdtemp(prefix='loadtest-')
+    try:
+        gsimg = import_gsimg()
+        fakes = None
+        if not (args.fakes or args.replay):
+            fakes = FakeApis(args.serve_fakes or 0, fake_images(args.images,
+                    args.img_mb, args.seed, IMG_MAX if args.composite is None
+                    else COMPOSITE_IMG_MAX), latency, args.errors,
+                    args.throttle, args.quota, args.mbps)
+            if args.serve_fakes:
+                print('Serving fake APIs at http://127.0.0.1:%d... Ctrl-C to '
+                        'quit' % args.serve_fakes)
+                try:
+                    fakes.serve_forever()
+                except KeyboardInterrupt:
+                    pass
+                sys.exit(0)
+            thread = threading.Thread(target=fakes.serve_forever)
+            thread.daemon = True
+            thread.start()
+
+        features = gsimg.features_arg(args.features)
+        if args.hedge:
+            gsimg.HEDGER = gsimg.Hedger(args.hedge, args.workers)
+        if args.wal:
+            gsimg.ROWS = gsimg.RowBuffer(os.path.join(workdir, 'rows.log'))
+        if args.spill is not None:
+            gsimg.SPILL_SIZE, gsimg.SPILL_DIR = int(args.spill * (1<<20)), workdir
+        if args.composite is not None:
+            if not (args.replay or google_crc32c):
+                parser.error('--composite requires google-crc32c')
+            gsimg.COMPOSITE = int(args.composite * (1<<20))
+            if args.ul_part:
+                gsimg.UL_PART = int(args.ul_part * (1<<20))
+        if args.backfill:
+            gsimg.BATCH_IMGS, gsimg.BATCH_POLL = BACKFILL_IMGS, BACKFILL_POLL
+        if args.replay:
+            http = Player(args.replay, args.timing, args.multiply)
+            print('Load-testing %d worker(s) replaying %r... please wait' % (
+                    args.workers, args.replay))
+        else:
+            base = args.fakes or 'http://127.0.0.1:%d' % fakes.server_address[1]
+            if args.http2 and not gsimg.httpx:
+                parser.error('--http2 requires httpx & h2')
+            http = LocalHttp(base, gsimg.Http2() if args.http2 else None)
+            print('Load-testing %d worker(s) against fake APIs at %s... please '
+                    'wait' % (args.workers, base))
+        for line in run(gsimg, http, args.workers, args.order, features,
+                args.backfill):
+            print(line)
+        if fakes and args.backfill:
+            print('Backfill:   %d Vision batch operation(s), %d status check(s)'
+                    % (len(fakes.ops), sum(op[0] for op in fakes.ops.values())))
+        if fakes and args.composite is not None:
+            print('Composite:  %d object(s) composed of %d part(s); %d part(s) '
+                    'left behind' % (fakes.composed['objects'],
+                    fakes.composed['parts'], sum(name.startswith(gsimg.UL_TMP)
+                    for _, name in fakes.objects)))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)